@@ -4,9 +4,23 @@ import numpy as np
 from scipy.interpolate import RectSphereBivariateSpline as spl_interp
 from scipy.interpolate import RegularGridInterpolator as gr_interp
 from scipy.ndimage import maximum_filter as max_filter
+from scipy.special import ndtri
 import configparser
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image, ImageFont, ImageDraw, GifImagePlugin
 import os
+import time
+import json
+import types
+import itertools
+import hashlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from contextlib import nullcontext
+try:
+    import numba    #optional, for compiled versions of sequential calculations
+except ImportError:
+    numba = None
 
 ver_num = "2.2.0"
 
@@ -84,8 +98,9 @@ option_def = {
     ## Main options, Set during configuration:
 
     #climate type and color options:
-    'land_type': 'Koppen-Geiger',       # main land climate zone type
+    'land_type': 'Koppen-Geiger',       # main land climate zone type; can also be a list of types or 'all' to make a map for each
     'land_subtype': 'full',             # land subtype
+    'extra_subtypes': None,             # additional subtypes to output by reducing the main land subtype map, if possible; list or comma-separated string
     'land_color': 'standard',           # land colors
     'sea_type': 'sea_standard',         # sea climate zone type
     'sea_subtype': 'full',              # sea climate zone subtype
@@ -94,6 +109,9 @@ option_def = {
 
     #additional processing options:
     'file_combine': 'data',             # approach for combining multiple files
+    'window_years': 0,                  # classify climate in rolling windows of this many files (years) each, rather than all files together
+    'window_step': 1,                   # number of files (years) to move forward between rolling windows
+    'ensemble': False,                  # classify each file separately, and map the most common zone in each cell and agreement with it
     'seasonless': False,                # average all data across time before finding zones
     'blend': True,                      # blend land and sea maps based on land mask
     'bin_months': 0,                    # reduce input months by binning sequential months together
@@ -110,11 +128,20 @@ option_def = {
     'sealev': 0,                        # sea level in topography map (m)
     'gravity': 9.81,                    # gravity used for scaling topography map to geopotential (m/s^2)
     'blend_topo': True,                 # use topography map for land/sea blend
+    'region': None,                     # (south, north, west, east) bounds of region to interpolate and classify, in degrees
+    'region_halo': 0,                   # number of extra output cells to include around region
 
     #output options:
     'make_key': False,                  # attempt to make a key of climates present in map
+    'key_area': False,                  # show portion of total surface area covered by each zone in map key
     'make_chart': False,                # make a chart of temperature and precipitation of each point, colored by zone
     'outname': 'output',                # output name
+    'image_palette': False,             # save map images as 8-bit indexed-color PNGs with a palette of the zones used, rather than RGB
+    'save_image': True,                 # save map images; can be disabled when only statistics are needed
+    'make_stats': False,                # save area covered by each zone, split by land/sea and latitude band ('csv' or 'json')
+    'stats_band': 30,                   # width of latitude bands for zone statistics (degrees)
+    'animate': False,                   # save animation of maps from each rolling window ('gif' or 'png')
+    'frame_time': 500,                  # time each frame of animation is shown (ms)
 
     ## Not set in configuration:
 
@@ -122,6 +149,15 @@ option_def = {
     'lapse_threshold': 981,             # threshold of geopotential difference between adjacent cells for determining empirical lapse rate
     'const_lapse_rate': None,           # constant lapse rate to use in place of empirical lapse rate (K/km, positive for increasing temp at lower elevation)
     'efficient': False,                 # use efficient version of climate algorithms, if available
+    'compress_cells': False,            # find land parameters only for land cells and sea parameters only for sea cells when blending
+    'use_numba': True,                  # use numba-compiled versions of sequential month-by-month calculations when numba is installed
+    'precision': None,                  # float type to keep data and parameters in ('float32' or 'float64'); None keeps input precision but interpolates to float64
+    'stream_files': True,               # open input files one at a time while reading data, rather than keeping all open at once
+    'param_processes': 1,               # number of processes used to find parameters for multiple files in parallel when using param file combination
+    'prefetch_files': False,            # read next file into memory in the background while processing current file when using param file combination
+    'cache_dir': None,                  # directory to save climate parameters to and reuse them from in later runs with the same files and options
+    'cache_size': 1000,                 # maximum total size of saved parameter files in cache_dir (MB), removing least recently used files past that
+    'warm_reuse': True,                 # reuse common and derived data from the previous run when running again with the same files
     'image_scale': None,                # scale to apply to final image, using nearest-neighbor interpolation; can be number to multiply resolution or tuple of (x,y) target resoluion
     'font_size': 20,                    # font size for map key and chart
     'debug_file': False,                # produce additional .nc file containing internally used data
@@ -1686,6 +1722,17 @@ name_key = {
     Ah:   'Ah: Hyperarid Desert'
     }
 
+#Index of variable names for each zone number, in order of definition, for finding names of zones in map key
+# zone_index[zone] = [(position, variable name), ...]
+#   names: dictionary of global names, in order of definition
+def index_zones(names):
+    index = {}
+    for i, (k, v) in enumerate(names.items()):
+        if type(v) is int:
+            index.setdefault(v, []).append((i, k))
+    return index
+zone_index = index_zones(dict(globals()))
+
 
 ### MAIN FUNCTIONS
 
@@ -1697,11 +1744,13 @@ name_key = {
 #       Make_clim() finds the appropriate land and sea _Data(), _Param(), and _Alg() functions listed in Clim_func{}
 #       files[] and functions (as land_funcs[] and sea_funcs[]) are then passed to Get_params()
 #           Get_params() extracts data arrays from files[] with nc.Dataset() as dat[]
+#               -or with stream_files, dat[] is just the file names, and each file is opened by Read_nc() only while its data is read
 #           then runs the appropriate land _Data() function on dat[]
 #               _Data() usually extracts climate data from dat[] with Get_nc(), passing it dat[] and the id key of the desired climate data
 #                   Get_nc() then finds the appropriate array in dat[] and saves it as dat_ar[]
 #                   -if using sequential file combination, arrays from each file are linked in sequence with np.concatenate()
 #                   -or if using data-averaging file combination, arrays from each file are extracted and then averaged together.
+#                       this uses a running sum, so only one file's array is held at a time besides the total
 #                   -if using interpolation, dat_ar[] is then passed to Interp() for interpolation
 #                   -if binning months, dat_ar[] is then passed to Bin_months() for binning
 #               each dat_ar[] is then passed back to _Data(), which combines them into all_data{} and returns it
@@ -1738,7 +1787,7 @@ name_key = {
 #            otherwise, they remain as separate maps
 #           in either case, clims[] arrays are saved to maps{}, which is returned
 #       Make_clim() receives and returns maps{}
-#   Make_map() passes maps{} to Make_image()
+#   Make_map() passes maps{} to Save_outputs(), which passes it to Make_image() and Make_stats() as set in options
 #       Make_image() retrieves a color map with Get_colmap()
 #           Get_colmap returns colmap[], which matches each clim id to an rgb color tuple
 #       then for each array in maps{},
@@ -1751,6 +1800,8 @@ name_key = {
 #           which constructs a single key image for all clim ids in maps{} and returns it
 #        Make_image() saves this as a .png file
 #       it then returns the last outim, though this is not currently used in the script
+#       -if making statistics, Make_stats() finds the area covered by each clim id in maps{}, split by land/sea and latitude band,
+#        and saves it as a .csv or .json file
 #   Make_map() returns with no output
 # if run directly, the script prompts for the option to run the process again, using the same files[] but separate configuration options
 # in summary, the general route to follow is
@@ -1772,6 +1823,14 @@ name_key = {
 #   Make_map <
 #           > Make_image
 #   
+# to compare two sets of files, Make_compare() runs Make_clim() for each in turn
+#   and passes both sets of maps to Compare_maps(), which saves a transition matrix and change map
+# Check_precision() similarly compares maps made with float64 and float32 precision
+# for rolling windows over many years, Make_map() calls Make_windows(), which extracts data once with Get_data()
+#   and runs the _Param functions and Get_clims() for the mean of each window
+# to try many settings of options used by _Alg functions, Make_sweep() finds parameters once with Find_params()
+#   and runs Get_clims() for each setting
+# Make_sensitivity() similarly finds parameters once, then runs Get_clims() on batches of randomly perturbed copies stacked together
 
 ##There are a couple alternatives to the standard Get_nc()
 # Get_nc_if() is given both dat[] and data{}
@@ -1784,6 +1843,11 @@ name_key = {
 #       finds the temperature/elevation lapse rate with Find_lapse()
 #   then compares the elevation data to the topography
 #   and constructs an appropriate map of temperature adjustments to apply to all temperature data
+# Get_derived() is given dat[] and the name of a derived field (e.g. 'tas' in C with adjustment, 'pet', 'evap', 'rin')
+#   it builds the field from Get_nc() and Get_nc_adjust() using the functions in Derived_func{}
+#   and keeps it in common{} so any later _Data function asking for it gets the same array without repeating work
+#   the cache is cleared by reset_derived() in Get_params() whenever the input files change
+#   This is now preferred over Get_nc_if() for any quantity used by more than one _Data function
 
 
 ##Configuration options can be set at a number of points:
@@ -1873,6 +1937,10 @@ kpasta_common = {}
 # options dictionary for use across all functions
 kpasta_options = option_def
 
+# common data and derived data kept from the last run, for reuse when running again with the same files
+#   not cleared by reset_default()
+kpasta_warm = {}
+
 # utility functions for easy and safe access to global dictionaries
 def opt(option):
     return kpasta_options[option]
@@ -1901,12 +1969,33 @@ path = os.path.join(os.path.dirname(__file__), '')
 #Dictionary of climate functions, to be filled in later
 Clim_func = {}
 
+#Dictionary of subtypes that can be derived from another subtype's map, to be filled in later
+# Subtype_tables[land_type][subtype] = (base subtypes it can be derived from, {zone: reduced zone})
+Subtype_tables = {}
+
 #Function for verbose output, just to save the extra line
 def verb(rep):
     if opt('verbose'):
         print(rep)
     return
 
+#Compiled versions of functions made by jit(), kept between runs
+numba_funcs = {}
+
+#Get numba-compiled version of a function for use on data arrays, compiling it on first use and caching the compiled code on disk
+# returns None if numba isn't installed, use_numba is off, or the arrays aren't all 3d with the same float type, in which case numpy should be used
+#   func: function to compile
+#   arrays: data arrays the function will be used on
+def jit(func, *arrays):
+    if numba is None or not opt('use_numba'):
+        return None
+    if len(set(a.dtype for a in arrays)) != 1 or arrays[0].dtype not in (np.float32, np.float64) or arrays[0].ndim != 3:
+        return None
+    if func not in numba_funcs:
+        verb(f'     Compiling {func.__name__} with numba')
+        numba_funcs[func] = numba.njit(cache=True)(func)
+    return numba_funcs[func]
+
 ## Input
 
 #Decide how an option value string should be interpreted and returns the appropriate data type
@@ -2098,6 +2187,7 @@ Land Climate Zone Type
 9:  World climate regions (Sayre et al. 2020)
 10: Two-parameter Koppen-alike
 11: Un-proxied Koppen-Geiger
+12: All of the above (separate map for each)
 Set land climate zone type: '''),
         ('Koppen-Geiger',
             'Trewartha',
@@ -2110,7 +2200,8 @@ Set land climate zone type: '''),
             'IPCC',
             'WCR',
             'TwoParamKG',
-            'KG_unproxied'
+            'KG_unproxied',
+            'all'
             ))
     if in_opts['land_type'] in ('Koppen-Geiger', 'KG_unproxied', 'TwoParamKG'):
         if in_opts['land_type'] == 'TwoParamKg':
@@ -2591,14 +2682,39 @@ def make_res(in_res, scale=None):
     return scale_out
 
 #Check if res has already been made, and if not make it, returning res either way
+# if using a region, this is the resolution of the region
 def get_res(in_res, scale=None):
     try:
         res = common('res')
     except:
         res = make_res(in_res, scale)
+        if opt('region'):
+            res = make_region(res)
         add_common('res', res)
     return res
 
+#Find rows and number of columns of full output map covered by region option, plus halo
+# saves full resolution and first row in common, and returns resolution of region
+# first column depends on longitude of map, so is found later by get_coords()
+#   res: full (y,x) output resolution
+def make_region(res):
+    south, north, west, east = opt('region')
+    halo = opt('region_halo')
+    lat = 90 - (np.arange(res[0]) + 0.5) * 180 / res[0]
+    rows = np.flatnonzero((lat >= south) & (lat <= north))
+    if len(rows) == 0:
+        rows = [np.argmin(np.abs(lat - (south+north)/2))]   #use nearest row if region is thinner than one
+    first = max(0, rows[0] - halo)
+    last = min(res[0], rows[-1] + 1 + halo)
+    width = (east - west) % 360
+    if width == 0:
+        width = 360
+    n_col = min(res[1], max(1, round(width / 360 * res[1])) + 2*halo)
+    add_common('res_full', res)
+    add_common('region_row', first)
+    print(f'  Interpolating only region of {last-first} rows and {n_col} columns out of {res[0]} by {res[1]}')
+    return (last - first, n_col)
+
 # return lat and lon if they have already been made, or make them
 #   big for big versions of coords
 #   startlon is starting longitude for left side of map
@@ -2611,8 +2727,19 @@ def get_coords(shape, big=False, startlon=0):
             lat = common('lat')
             lon = common('lon')
     except:
+        region = big and 'res_full' in kpasta_common
+        if region:
+            n_col = shape[1]
+            shape = common('res_full')
         lat = np.linspace(math.pi/2 - math.pi/(2*shape[0]), -math.pi/2 + math.pi/(2*shape[0]), shape[0])
         lon = np.linspace(startlon + math.pi/shape[1], startlon + 2*math.pi - math.pi/shape[1], shape[1])
+        if region:  #cut down to region, with columns wrapping around edge of map if necessary
+            row = common('region_row')
+            west = (opt('region')[2] - opt('region_halo') * 360 / shape[1]) * math.pi/180
+            col = math.ceil(((west - startlon) % (2*math.pi)) / (2*math.pi) * shape[1] - 0.5) % shape[1]
+            add_common('region_col', col)
+            lat = lat[row:row+common('res')[0]]
+            lon = lon[(col + np.arange(n_col)) % shape[1]]
         if big:
             verb('   Calculated lat and lon arrays at output resolution')
             add_common('lat_big', lat)
@@ -2684,11 +2811,14 @@ def Interp(data, res=None, interp_type=None, coords_in=None, coords_out=None, ma
                 go = False
         if go:
             data = np.where(mask, max_filter(data, (0,3,3), mode=('constant','wrap','nearest'), cval=1.0), data)   #apply dummy ice to land areas by copying max of neighboring sea ice values
-    n_data = np.empty((d_shape[0],res[0],res[1]))
+    n_data = np.empty((d_shape[0],res[0],res[1]), dtype=opt('precision') or np.float64)
     if interp_type == 'spline':
         for t in range(d_shape[0]):
             lon_i = lon - (lon[0] + lon[-1]) / 2      #shift lon to center at 0
-            lon_out_i = lon_out - (lon_out[0] + lon_out[-1]) / 2
+            if 'res_full' in kpasta_common:
+                lon_out_i = (lon_out - (lon[0] + lon[-1]) / 2 + math.pi) % (2*math.pi) - math.pi  #region is shifted like input
+            else:
+                lon_out_i = lon_out - (lon_out[0] + lon_out[-1]) / 2
             interp = spl_interp(math.pi/2 - lat, lon_i, data[t,:,:])
             n_data[t,:,:] = interp.ev(lat_out,lon_out_i).reshape((res[1],res[0])).T
     else:
@@ -2798,16 +2928,32 @@ def Read_topo(topo_map=None, res=None, maxel=None, minel=None, sealev=None, grav
     except:
         verb('     First attempt to convert mask array back to image failed, attempting to read as uint8')
         hmap_bin = Image.fromarray(hmap_bin_ar.astype(np.uint8))    #I dunno why the first version fails for some people, this might help
-    hmap_bin = hmap_bin.resize(res, Image.Resampling.BILINEAR)
-    topo_bin = np.asarray(hmap_bin)
+    topo_bin = resize_topo(hmap_bin, res)
     topo_mask = np.where(topo_bin > 50, True, False)  # re-binarize after downscaling
     verb('     Resampling and scaling topo elevation')
-    hmap = hmap.resize(res, Image.Resampling.BILINEAR)
-    elev = np.asarray(hmap)
+    elev = resize_topo(hmap, res)
     elev = elev * (maxel - minel) / (hmapext[1] - hmapext[0]) * gravity #scale to geopotential
     verb(f'     Topo elevation map produced with geopotential range of {np.amin(elev)} to {np.amax(elev)}')
     return elev, topo_mask
 
+#Resize topography image to output resolution, returning array
+# if using a region, only the part of the image in the region is resized
+#   im: topography image
+#   res: target (x,y) size
+def resize_topo(im, res):
+    if 'region_col' not in kpasta_common or res != (common('res')[1], common('res')[0]):
+        return np.asarray(im.resize(res, Image.Resampling.BILINEAR))
+    full = common('res_full')
+    row = common('region_row')
+    col = common('region_col')
+    sx = im.size[0] / full[1]
+    sy = im.size[1] / full[0]
+    parts = []
+    for a, b in ((col, min(col + res[0], full[1])), (0, col + res[0] - full[1])):   #second part if region wraps around edge of map
+        if b > a:
+            parts.append(np.asarray(im.resize((b-a, res[1]), Image.Resampling.BILINEAR, box=(a*sx, row*sy, b*sx, (row+res[1])*sy))))
+    return np.concatenate(parts, 1)
+
 #Calculate potential evapotranspiration
 # returns PET in mm/month
 #   asce-pm method Based on implementation in pyet package but without xarray dependency
@@ -2852,7 +2998,6 @@ def Calc_PET(method='asce_pm', tas=None, maxt=None, mint=None, rnet=None, rin=No
     else:
         if rnet is None:
             raise Exception('Calc_PET requires absorbed surface radiation input for asce_pm or hargreaves methods')
-        rnetm = rnet * 0.0864 #converts to MJ/m^2*day
         if hur is None:
             raise Exception('Calc_PET requires relative humidity input for asce_pm method')
         if ps is None:
@@ -2868,47 +3013,78 @@ def Calc_PET(method='asce_pm', tas=None, maxt=None, mint=None, rnet=None, rin=No
             gsoil = 0
         else:
             gsoil = 0.07 *(np.roll(tsoil, 1, 0) - np.roll(tsoil, 1, 0))     #estimate net heat flux to soil by soil temperature change
+        if maxt is None or mint is None:
+            verb('     No daily maxt and mint found in Calc_PET, ignoring diurnal temp variation')
+        if method == 'asce-pm' and vegf is None:    #if no vegetation input, split the difference
+            verb('     No vegetation found in Calc_PET, using backup')
+            vegf = 0.5
+
+        ins = (tas, maxt, mint, rnet, hur, ps, wind, gsoil, vegf)
+        shape = np.broadcast_shapes(*[np.shape(v) for v in ins if v is not None])
+        pet = None
+        for t in range(shape[0]) if len(shape) == 3 else [None]:    #work through one month at a time, so temporary arrays are only month-sized
+            pet_t = pm_pet(method, *[month_slice(v, t, len(shape)) for v in ins])
+            if t is None:
+                pet = pet_t
+                break
+            if pet is None:
+                pet = np.empty(shape, dtype=pet_t.dtype)
+            pet[t] = pet_t
 
-        
-        
-        lambd = 2.501 - 0.002361 * tas    #latent heat of water vaporization, MJ/kg
-        #asce-pm guidelines say to set lambd as constant, but I'm leaving it in
-        
-        #if not ts:
-        #    gamma = 0.000665 * ps #backup option if for whatever reason I remove temperature dependency
-        #else:
-        cp = 0.001013   #specific heat of air, MJ/kg*K
-        rat = 0.622 * 287.05 / opt('pet_gascon')    #ratio of molecular weights of water and dry air
-        gamma = cp * ps / (rat * lambd)    #psychrometric constant, kPa/K
-        
+    np.multiply(pet, 30, out=pet)   #convert to mm/month
+    np.copyto(pet, 0, where=pet < 0)   #clamp to positive values
+    return pet
 
-        es = 0.6108 * np.exp(17.27 * tas / (tas + 237.3)) #saturation pressure at constant t, kPa
-        delt = 4098 * es / (tas + 237.3)**2  #slope of saturation curve, kPa/K
+#Take single month from array with time axis for month-by-month calculation
+# returns arrays without time axis and scalars unchanged
+#   v: array or scalar
+#   t: month index, or None to return v unchanged
+#   ndim: number of dimensions of arrays with time axis
+def month_slice(v, t, ndim):
+    if t is None or np.ndim(v) < ndim:
+        return v
+    if len(v) == 1:
+        return v[0]
+    return v[t]
+
+#Penman-Monteith PET calculation for Calc_PET, applied to data for a single month or the whole year
+# returns PET in mm/day, without clamping
+#   method: 'asce-pm' to include vegetation-dependent wind terms
+#   gsoil: net heat flux to soil in MJ/m^2*day
+#   other inputs as in Calc_PET, with maxt or mint None to ignore diurnal temp variation
+def pm_pet(method, tas, maxt, mint, rnet, hur, ps, wind, gsoil, vegf):
+    rnetm = rnet * 0.0864 #converts to MJ/m^2*day
+    lambd = 2.501 - 0.002361 * tas    #latent heat of water vaporization, MJ/kg
+    #asce-pm guidelines say to set lambd as constant, but I'm leaving it in
+    
+    #if not ts:
+    #    gamma = 0.000665 * ps #backup option if for whatever reason I remove temperature dependency
+    #else:
+    cp = 0.001013   #specific heat of air, MJ/kg*K
+    rat = 0.622 * 287.05 / opt('pet_gascon')    #ratio of molecular weights of water and dry air
+    gamma = cp * ps / (rat * lambd)    #psychrometric constant, kPa/K
+    
 
-        if not (maxt is None or mint is None):
-            esmax = 0.6108 * np.exp(17.27 * maxt / (maxt + 237.3))
-            esmin = 0.6108 * np.exp(17.27 * mint / (mint + 237.3))
-            esav = (esmax + esmin)/2
-        else:
-            verb('     No daily maxt and mint found in Calc_PET, ignoring diurnal temp variation')
-            esav = es    #average saturation pressure, kPa
-        ea = esav * hur / 100      #actual vapor pressure, kPa
-        de = es - ea    #vapor pressure deficit, kPa
-        if method == 'asce-pm': #may add option for more regular pm, which excludes this
-            if vegf is None:    #if no vegetation input, split the difference
-                verb('     No vegetation found in Calc_PET, using backup')
-                vegf = 0.5
-            cn = (900 + 500 * vegf)     #interpolate between tall and short reference vegetation based on forest cover
-            cd = (0.34 + 0.04 * vegf)
-            ga = wind * cn/(tas + 273.15) #wind factor
-            denom = 1 + cd * wind
-        else:
-            ga = 1 + 0.537 * wind
-            denom = 1
-        pet = ((delt * (rnetm - gsoil) / lambd) + gamma * ga * de) / (delt + gamma * denom) #calculates as mm/day, for ease of use with asce coefficients
-        
-    pet = np.where(pet < 0, 0, 30*pet)  #clamp to positive values and convert to mm/month
-    return pet
+    es = 0.6108 * np.exp(17.27 * tas / (tas + 237.3)) #saturation pressure at constant t, kPa
+    delt = 4098 * es / (tas + 237.3)**2  #slope of saturation curve, kPa/K
+
+    if not (maxt is None or mint is None):
+        esmax = 0.6108 * np.exp(17.27 * maxt / (maxt + 237.3))
+        esmin = 0.6108 * np.exp(17.27 * mint / (mint + 237.3))
+        esav = (esmax + esmin)/2
+    else:
+        esav = es    #average saturation pressure, kPa
+    ea = esav * hur / 100      #actual vapor pressure, kPa
+    de = es - ea    #vapor pressure deficit, kPa
+    if method == 'asce-pm': #may add option for more regular pm, which excludes this
+        cn = (900 + 500 * vegf)     #interpolate between tall and short reference vegetation based on forest cover
+        cd = (0.34 + 0.04 * vegf)
+        ga = wind * cn/(tas + 273.15) #wind factor
+        denom = 1 + cd * wind
+    else:
+        ga = 1 + 0.537 * wind
+        denom = 1
+    return ((delt * (rnetm - gsoil) / lambd) + gamma * ga * de) / (delt + gamma * denom) #calculates as mm/day, for ease of use with asce coefficients
 
 #Calculate growing degree-days
 # returns GDD/month
@@ -2948,7 +3124,17 @@ def Calc_GDD_total(gdd, gint=None, cont=None, inf=None, th_gi=1250):
     if inf is None:
         inf = opt('gdd_indicate_inf')
     if cont and len(gdd) > 1:   #check for largest contiguous accumulation of gdd rather than total; skip if seasonless
-        if gint is None:
+        kernel = jit(gdd_accumulate, gdd, gdd if gint is None else gint)
+        if kernel is not None:
+            gdd_acc = np.copy(gdd)
+            if gint is None:
+                gint_acc = np.ones_like(gdd) * 1e6
+                kernel(gdd, gint_acc, gdd_acc, gint_acc, False, inf, np.array([th_gi], dtype=gdd.dtype))
+            else:
+                gint_acc = np.copy(gint)
+                kernel(gdd, gint, gdd_acc, gint_acc, True, inf, np.array([th_gi], dtype=gdd.dtype))
+                gint_tot = np.amax(gint_acc, 0)
+        elif gint is None:
             gint_acc = np.ones_like(gdd) * 1e6  #set high so that it's always high enough to interrupt GDD
         else:
             gint_acc = np.copy(gint)
@@ -2962,11 +3148,12 @@ def Calc_GDD_total(gdd, gint=None, cont=None, inf=None, th_gi=1250):
                     tn = len(gint) - (t+1)
                     gint_acc[tn-1,:,:] = np.where(np.minimum(gint[tn,:,:],gint[tn-1,:,:]) > 0, gint_acc[tn,:,:], gint_acc[tn-1,:,:])    #propogate total of each gint period backwards to rest of period
             gint_tot = np.amax(gint_acc, 0)
-        gdd_acc = np.copy(gdd)
-        for i in range(2):
-            for t in range(len(gdd)):
-                gdd_n = gdd[t,:,:] + gdd_acc[t-1,:,:]
-                gdd_acc[t,:,:] = np.where(gdd[t,:,:] > 0, gdd_n, np.where(gint_acc[t,:,:] > th_gi, 0, gdd_n))   #accumulate gdd forward, interrupting only in large gint periods
+        if kernel is None:
+            gdd_acc = np.copy(gdd)
+            for i in range(2):
+                for t in range(len(gdd)):
+                    gdd_n = gdd[t,:,:] + gdd_acc[t-1,:,:]
+                    gdd_acc[t,:,:] = np.where(gdd[t,:,:] > 0, gdd_n, np.where(gint_acc[t,:,:] > th_gi, 0, gdd_n))   #accumulate gdd forward, interrupting only in large gint periods
         gdd_tot = np.amax(gdd_acc, 0)
 
     else:
@@ -2983,6 +3170,40 @@ def Calc_GDD_total(gdd, gint=None, cont=None, inf=None, th_gi=1250):
     else:
         return gdd_tot, gint_tot
 
+#Accumulate gint and gdd for each cell through the 3 loops described for Calc_GDD_total
+# compiled with numba by jit(); fills gdd_acc and gint_acc in place
+#   gdd, gint: monthly gdd and gint arrays
+#   gdd_acc, gint_acc: copies of gdd and gint to accumulate in, with gint_acc set to 1 million and gint unused if not counting gint
+#   use_gint: whether gint is counted
+#   inf: set last month of gint_acc to 1 million where all months have gint
+#   c: array with gint threshold in the same dtype as data, so comparisons match numpy
+def gdd_accumulate(gdd, gint, gdd_acc, gint_acc, use_gint, inf, c):
+    nt = gdd.shape[0]
+    for y in range(gdd.shape[1]):
+        for x in range(gdd.shape[2]):
+            if use_gint:
+                for i in range(2):
+                    for t in range(nt):
+                        gint_acc[t,y,x] = gint[t,y,x] + gint_acc[t-1,y,x] if gint[t,y,x] > 0 else 0
+                if inf:
+                    low = gint_acc[0,y,x]
+                    for t in range(1, nt):
+                        low = np.minimum(low, gint_acc[t,y,x])
+                    if low > 0:
+                        gint_acc[-1,y,x] = 1e6
+                for i in range(2):
+                    for t in range(nt):
+                        tn = nt - (t+1)
+                        if np.minimum(gint[tn,y,x], gint[tn-1,y,x]) > 0:
+                            gint_acc[tn-1,y,x] = gint_acc[tn,y,x]
+            for i in range(2):
+                for t in range(nt):
+                    gdd_n = gdd[t,y,x] + gdd_acc[t-1,y,x]
+                    if gdd[t,y,x] > 0 or not gint_acc[t,y,x] > c[0]:
+                        gdd_acc[t,y,x] = gdd_n
+                    else:
+                        gdd_acc[t,y,x] = 0
+
 #Estimate evaporation from precipitation and PET using simple soil water model
 # returns monthly evaporation in mm/month
 #   pet: total monthly potential evapotranspiration in mm/month
@@ -2993,17 +3214,44 @@ def Estimate_evap(pet, pr):
     soilw = np.zeros_like(pet)  #soil water at end of each month
     diff = np.zeros_like(pet[0,:,:]) + 1000     #difference in soil water between first and final states
     surpdef = pet - pr  #surplus or deficit of pet over pr each month
+    kernel = jit(evap_year, pet, pr)
     while np.amax(diff) > 10:   #iterate through year until there's less than a 1 cm discrepency in starting soil water anywhere in the world
         initsw = soilw[-1,:,:]
-        for t in range(pet.shape[0]):
-            sev = np.minimum(soilw[t-1,:,:], surpdef[t,:,:] * np.minimum(soilw[t-1,:,:],250)/250)   #soil evaporation rate limited by soil water content and saturation when below 25 cm
-            evap[t,:,:] = np.where(surpdef[t,:,:] > 0, pr[t,:,:] + sev, pet[t,:,:])     #evaporation equal to pet where pr exceeds it, pr + soil evaporation otherwise
-            soilw[t,:,:] = np.minimum (500, soilw[t-1,:,:] - np.where(surpdef[t,:,:] > 0, sev, surpdef[t,:,:]))     #soil water adjusted but limited to 50 cm
+        if kernel is not None:
+            kernel(pet, pr, surpdef, evap, soilw, np.array([250, 500], dtype=pet.dtype))
+        else:
+            for t in range(pet.shape[0]):
+                sev = np.minimum(soilw[t-1,:,:], surpdef[t,:,:] * np.minimum(soilw[t-1,:,:],250)/250)   #soil evaporation rate limited by soil water content and saturation when below 25 cm
+                evap[t,:,:] = np.where(surpdef[t,:,:] > 0, pr[t,:,:] + sev, pet[t,:,:])     #evaporation equal to pet where pr exceeds it, pr + soil evaporation otherwise
+                soilw[t,:,:] = np.minimum (500, soilw[t-1,:,:] - np.where(surpdef[t,:,:] > 0, sev, surpdef[t,:,:]))     #soil water adjusted but limited to 50 cm
         diff = np.absolute(soilw[-1,:,:] - initsw)
     return evap
 
+#Run soil water model through one year for each cell, as in Estimate_evap
+# compiled with numba by jit(); fills evap and soilw in place
+#   pet, pr, surpdef: pet, precipitation, and pet - pr arrays
+#   evap, soilw: evaporation and soil water arrays to fill
+#   c: array of constants (soil water saturation and limit) in the same dtype as data, so calculations match numpy
+def evap_year(pet, pr, surpdef, evap, soilw, c):
+    for y in range(pet.shape[1]):
+        for x in range(pet.shape[2]):
+            for t in range(pet.shape[0]):
+                sw = soilw[t-1,y,x]
+                sd = surpdef[t,y,x]
+                sev = np.minimum(sw, sd * np.minimum(sw, c[0]) / c[0])
+                if sd > 0:
+                    evap[t,y,x] = pr[t,y,x] + sev
+                    soilw[t,y,x] = np.minimum(c[1], sw - sev)
+                else:
+                    evap[t,y,x] = pet[t,y,x]
+                    soilw[t,y,x] = np.minimum(c[1], sw - sd)
+
+#Radiation profiles from Estimate_rad() for each latitude grid and orbit, kept between runs
+rad_cache = {}
+
 #Estimate monthly average surface radiation based on orbit, rotation, and latitude
 # returns average radiation data array in W/m^2
+#  as a read-only view of the radiation for each month and latitude broadcast across longitude, so copy it before modifying in place
 # Only works for rapidly rotating planets (day length << month length)
 #   ex: example data array to copy size
 #   lat: latitude array to use
@@ -3016,66 +3264,118 @@ def Estimate_evap(pet, pr):
 #   loss = portion of flux presumed lost in atmosphere
 def Estimate_rad(ex, lat=None, obl=23.44, ecc=0.0, argobl=0, solmonth=5, monthoff=-6, flux=1367, loss=1/4):
     verb('    Estimating surface radiation from orbital parameters and latitude')
-    flux = flux * (1-loss)
     ashape = ex.shape
     if len(ashape) < 3:
         ashape = (12,ashape[0],ashape[1])   #if working without time dimension, will find average from year by sampling from 12 months
     if lat is None:
         lat,lon = get_coords((ashape[1], ashape[2]), big=True)
-    anoms = np.linspace(0, 360, ashape[0], endpoint=False)     #create array of mean anomaly for each month
-    anoms = np.roll(anoms, solmonth)        #offset to place 0 mean anom at sum solstice
-    anoms = anoms + monthoff     #offset based on monthoff
-    anoms = anoms % 360     #constrain to 0-360 range
-    if ecc > 0.0:
-        anoms -= argobl #shift to count from vernal equinox
-        anoms = anoms % 360
-        tanoms = anoms
-        for m in range(len(anoms)):     #find eccentric anomaly by newton's method
-            a = anoms[m]
-            if a == 0 or a==180:  #skip if 0 or 180
-                continue
-            ecca = a
-            ecca1 = ecc + 180
-            while abs(ecca-ecca1) > 0.1:  #0.1 degree tolerance
-                ecca1 = ecca
-                ecca = ecca - math.degrees((math.radians(ecca) - ecc * math.sin(math.radians(ecca)) - math.radians(a)) /
-                    1 - ecc * math.cos(math.radians(ecca)))
-            ta = math.degrees(math.acos((math.cos(math.radians(ecca))-ecc) /
-                (1 - ecc * math.cos(math.radians(ecca)))))      #convert to true anomaly
-            if ecca > 180:  #adjust for domains
-                ta *= -1
-                ta += 360
-            tanoms[m] = ta
-        dists = (1-ecc**2) / (1+ecc * math.cos(math.radians(tanoms)))  #distance from star relative to SMA
-        fluxes = flux / dist**2  #stellar flux at each point in orbit
-        tanoms += argobl #shift back to count from solstice
-        tanoms = tanoms % 360
+    key = (np.asarray(lat).tobytes(), ashape[0], obl, ecc, argobl, solmonth, monthoff, flux, loss)
+    if key in rad_cache:
+        verb('     Reusing radiation from previous estimate')
+        qd = rad_cache[key]
     else:
-        fluxes = np.ones_like(anoms) * flux #if no eccentricity, constant flux
-        tanoms = anoms
-    decs = np.sin(np.radians(tanoms+90)) * math.radians(180 - obl if obl > 90 else obl)    #stellar declination
-
-    qds = []
+        flux = flux * (1-loss)
+        anoms = np.linspace(0, 360, ashape[0], endpoint=False)     #create array of mean anomaly for each month
+        anoms = np.roll(anoms, solmonth)        #offset to place 0 mean anom at sum solstice
+        anoms = anoms + monthoff     #offset based on monthoff
+        anoms = anoms % 360     #constrain to 0-360 range
+        if ecc > 0.0:
+            anoms -= argobl #shift to count from vernal equinox
+            anoms = anoms % 360
+            mean = np.radians(anoms)
+            ecca = np.copy(mean) if ecc < 0.8 else np.full_like(mean, math.pi)   #start from pi for high eccentricity, where newton's method may not converge from mean anomaly
+            step = np.full_like(ecca, math.pi)
+            while np.amax(np.absolute(step)) > math.radians(0.1):   #find eccentric anomaly of all months by newton's method, to 0.1 degree tolerance
+                step = (ecca - ecc * np.sin(ecca) - mean) / (1 - ecc * np.cos(ecca))
+                ecca -= step
+            tanoms = np.degrees(np.arccos(np.clip((np.cos(ecca) - ecc) / (1 - ecc * np.cos(ecca)), -1, 1)))    #convert to true anomaly
+            tanoms = np.where(ecca % (2*math.pi) > math.pi, 360 - tanoms, tanoms)    #adjust for domains
+            dists = (1-ecc**2) / (1+ecc * np.cos(np.radians(tanoms)))  #distance from star relative to SMA
+            fluxes = flux / dists**2  #stellar flux at each point in orbit
+            tanoms += argobl #shift back to count from solstice
+            tanoms = tanoms % 360
+        else:
+            fluxes = np.ones_like(anoms) * flux #if no eccentricity, constant flux
+            tanoms = anoms
+        decs = np.sin(np.radians(tanoms+90)) * math.radians(180 - obl if obl > 90 else obl)    #stellar declination
+        decs = decs[:,None]     #months along first axis and latitudes along second
 
-    for m in range(len(decs)):
-        dec = decs[m]
-        ind = np.tan(lat) * math.tan(dec)
+        ind = np.tan(lat) * np.tan(decs)
         ind = np.where(ind > 1, -1, np.where(ind < -1, 1, -ind))
         ho = np.arccos(ind)     #hour angle of sunrise
         #ho = np.where(ind > 1, math.pi, np.where(ind < -1, 0, np.arccos(-ind)))
-        qd = fluxes[m] / math.pi * (ho * np.sin(lat) * math.sin(dec) + np.cos(lat) * math.cos(dec) * np.sin(ho))
-        qd = qd * np.ones([ashape[2],ashape[1]])
-        qd = np.swapaxes(qd, 0, 1)
-        qds.append(qd)
-    
-    rad = np.stack(qds)
+        qd = fluxes[:,None] / math.pi * (ho * np.sin(lat) * np.sin(decs) + np.cos(lat) * np.cos(decs) * np.sin(ho))
+        rad_cache[key] = qd
 
-    if len(ashape) < 3:
-        rad = np.mean(rad, 0)
+    if ex.ndim < 3:
+        return np.broadcast_to(np.mean(qd, 0)[:,None], ashape[1:])
+    return np.broadcast_to(qd[:,:,None], ashape)
 
-    return rad
 
 
+#Read whole file into memory, e.g. to open with nc.Dataset(name, memory=buf)
+# returns file contents as bytes
+#   name: file name
+def Read_file(name):
+    with open(name, 'rb') as f:
+        return f.read()
+
+#Read single variable from one input file
+# returns the data array
+#   d: netcdf data object, or file name to open just for this read (with masking off, so a plain float array is returned)
+#   key: data key in file
+#   low: pick last atmospheric layer in (time, layer, lat, lon) array
+#   single: only read first timestep
+def Read_nc(d, key, low=False, single=False):
+    if isinstance(d, str):
+        with nc.Dataset(d) as f:
+            f.set_auto_mask(False)
+            return Read_nc(f, key, low=low, single=single)
+    var = d[key]
+    if single:
+        if low:
+            return var[0,-1,:,:]
+        return var[0,:,:]
+    if low:
+        return var[:,-1,:,:]
+    return var[:]
+
+#Read single variable from each input file in order
+# yields the data array from each file
+# files are read one after another, as the netcdf library isn't safe to call from multiple threads at once
+#   dat: list of input netcdf data objects or file names
+#   key: data key in file
+#   low: pick last atmospheric layer in (time, layer, lat, lon) array
+def Iter_nc(dat, key, low=False):
+    for d in dat:
+        yield Read_nc(d, key, low=low)
+
+#Time reading a variable from increasing numbers of files
+# prints and returns dictionary of {file count: files read per second}
+#   files: list of input file names
+#   key: data key in file
+#   repeat: times to repeat each read, taking the fastest
+def Bench_read(files, key='tas', repeat=3):
+    results = {}
+    counts = sorted(set([1] + [2**i for i in range(1, len(files).bit_length()) if 2**i < len(files)] + [len(files)]))
+    print(f' Reading {key} from up to {len(files)} files')
+    print('  files   files/s')
+    for n in counts:
+        best = None
+        for r in range(repeat):
+            start = time.perf_counter()
+            total = None
+            for d_ar in Iter_nc(files[:n], key):
+                if total is None:
+                    total = np.array(d_ar)
+                else:
+                    total += d_ar
+            took = time.perf_counter() - start
+            if best is None or took < best:
+                best = took
+        results[n] = n / best
+        print(f'  {n:>5} {n/best:>9.1f}')
+    return results
 
 #Pull data from exoplasim output netcdf file and process as necessary
 # returns the processed array
@@ -3092,31 +3392,32 @@ def Get_nc(dat, key, coords=None, res=None, single=False, no_interp=False, adjus
     verb(f'    Extracting {key}')
     if single:
         try:
-            if low:
-                dat_ar = dat[0][key][0,-1,:,:]
-            else:
-                dat_ar = dat[0][key][0,:,:]
+            dat_ar = Read_nc(dat[0], key, low=low, single=True)
             dat_ar = np.expand_dims(dat_ar, 0)  #keep time dimension so it's present for other functions
         except:
-            dat_ar = dat[0][key][:]
+            dat_ar = Read_nc(dat[0], key)
     elif opt('file_combine') == 'seq':  #link data from each file along time dimension into single long array
-        if low:
-            dat_ar = [d[key][:,-1,:,:] for d in dat]
-        else:
-            dat_ar = [d[key][:] for d in dat]
-        dat_ar = np.concatenate(dat_ar, 0)
-    else:
         dat_ar = None
-        for d in dat:
-            if low:
-                d_ar = d[key][:,-1,:,:]
+        t = 0
+        for d_ar in Iter_nc(dat, key, low=low):
+            if dat_ar is None:
+                dat_ar = np.empty((d_ar.shape[0]*len(dat),) + d_ar.shape[1:], dtype=opt('precision') or d_ar.dtype)  #preallocate presuming all files are the same length
+            if t + d_ar.shape[0] > dat_ar.shape[0]:
+                dat_ar = np.concatenate((dat_ar[:t], d_ar), 0)  #extend if a file is longer than expected
             else:
-                d_ar = d[key][:]
+                dat_ar[t:t+d_ar.shape[0]] = d_ar
+            t += d_ar.shape[0]
+        dat_ar = dat_ar[:t]
+    else:
+        dat_ar = None
+        for d_ar in Iter_nc(dat, key, low=low):   #keep running sum, so only one file's data is held at a time besides the sum
             if dat_ar is not None:
                 dat_ar += d_ar
             else:
-                dat_ar = d_ar
+                dat_ar = d_ar.astype(opt('precision') or d_ar.dtype, copy=False)    #sum at working precision
         dat_ar /= len(dat)  #sum values from all input files and then divide by file number to average
+    if opt('precision'):
+        dat_ar = dat_ar.astype(opt('precision'), copy=False)
     if opt('bin_months') > 1 and not single:
         verb('     Binning data')
         dat_ar = Bin_months(dat_ar, opt('bin_months'), ext=bin_ext)
@@ -3204,9 +3505,10 @@ def Get_nc_adjust(dat, t_key, g_key, coords=None, res=None, topo=None, t_unadjus
         t_ar += adjust
     return t_ar, adjust
 
-#standard function to extract pet and optionally evap from ExoPlaSim outputs
+#standard function to extract pet from ExoPlaSim outputs
 # dat: dat to extract parameters from
-# data: previously extracted parameters
+# data: temperatures in C to use for PET (tas, maxt, mint); any not included are taken from derived data, and maxt or mint set to None ignores diurnal variation
+#   also include adjust to apply topographic adjustment to soil temperature
 # pet_method: method for estimating pet
 # no_interp: produce without interpolation
 def Get_pet(dat, data, pet_method=None, no_interp=False):
@@ -3219,40 +3521,35 @@ def Get_pet(dat, data, pet_method=None, no_interp=False):
         adjust = data['adjust']
     else:
         adjust = 0
-    tas,w = Get_nc_if(dat, 'tas', data, adjust=adjust+opt('temp_adjust'), no_interp=no_interp)
+    if 'tas' in data:
+        tas = data['tas']
+    else:
+        tas = Get_derived(dat, 'tas', no_interp)
     if pet_method == 'kalike':
         pet = Calc_PET(method = pet_method,
                        tas=tas)
 
     elif pet_method == 'hargreaves':
-        rss,w = Get_nc_if(dat, 'rss', data, no_interp=no_interp)
+        rss = Get_derived(dat, 'rss', no_interp)
         pet = Calc_PET(method = pet_method,
                        tas=tas,
                        rin=rss)
         
     else:
-        rss,w = Get_nc_if(dat, 'rss', data, no_interp=no_interp)
-        rls,w = Get_nc_if(dat, 'rls', data, no_interp=no_interp)
-        hur,w = Get_nc_if(dat, 'hur', data, low=True, no_interp=no_interp)
-        ps,w = Get_nc_if(dat, 'ps', data, no_interp=no_interp)
-        spd,w = Get_nc_if(dat, 'spd', data, low=True, no_interp=no_interp)
-        maxt,w = Get_nc_if(dat, 'maxt', data, 'maxt', adjust=adjust+opt('temp_adjust'), no_interp=no_interp)
-        mint,v = Get_nc_if(dat, 'mint', data, 'mint', adjust=adjust+opt('temp_adjust'), no_interp=no_interp)
-        if not w or not v:
-            ts,w = Get_nc_if(dat, 'ts', data, adjust=adjust+opt('temp_adjust'), no_interp=no_interp)
-            tdif = tas - ts#adjustment from surface to 2-meter to apply to maxt and mint
-            maxt += tdif
-            mint += tdif
-        tsoil,w = Get_nc_if(dat, 'tso', data, no_interp=no_interp)
+        rss = Get_derived(dat, 'rss', no_interp)
+        rls = Get_derived(dat, 'rls', no_interp)
+        hur = Get_derived(dat, 'hur', no_interp)
+        ps = Get_derived(dat, 'ps', no_interp)
+        spd = Get_derived(dat, 'spd', no_interp)
+        maxt = data['maxt'] if 'maxt' in data else Get_derived(dat, 'maxt', no_interp)    #None in data ignores diurnal variation
+        mint = data['mint'] if 'mint' in data else Get_derived(dat, 'mint', no_interp)
+        tsoil = Get_derived(dat, 'tso', no_interp)
         tsoil = np.where(tsoil > -200-opt('temp_adjust'), tsoil+adjust, tsoil) #don't adjust tsoil over seas, which are filled in as 0
         if opt('pet_use_vegf'):
-            try:
-                vegf = Get_nc(dat, 'vegf', no_interp=no_interp)
-            except:
-                vegf = None
+            vegf = Get_derived(dat, 'vegf', no_interp)
         else:
             vegf = None
-        pet = Calc_PET(method = opt('pet_method'),
+        pet = Calc_PET(method = pet_method,
                       tas=tas,
                       maxt=maxt,
                       mint=mint,
@@ -3286,6 +3583,185 @@ def get_mask(dat, key, convert=False):
         add_common('mask', mask)
     return mask
 
+## Derived data
+
+# Derived fields are quantities built from one or more variables in the files
+#  (e.g. temperature in C with topographic adjustment, incident radiation, PET, evaporation)
+#  that may be needed by the land, sea, and extra _Data functions alike
+# Get_derived() computes each field at most once per set of input files at each resolution,
+#  keeping them in kpasta_common{} under 'derived' and logging the time taken for each under 'derived_log'
+# Each field is listed in Derived_func{} as (function, dependencies)
+#   the function takes (dat, no_interp) and returns an array, or a dictionary of arrays for fields computed together
+#   dependencies are derived before the function is run
+# Derived arrays are shared between functions, so they should not be modified in place
+
+#Dictionary of derived data functions, to be filled in below
+Derived_func = {}
+
+#Clear all derived data, e.g. before extracting from a new set of files
+def reset_derived():
+    kpasta_common['derived'] = {}
+    kpasta_common['derived_log'] = []
+    kpasta_common['derived_stack'] = []
+
+#Return derived field from common if already made, otherwise make it
+#   dat: list of input netcdf data objects
+#   key: name of derived field in Derived_func
+#   no_interp: produce at original resolution rather than interpolated resolution
+def Get_derived(dat, key, no_interp=False):
+    small = bool(no_interp and opt('interp_scale'))     #without interpolation both resolutions are the same
+    if 'derived' not in kpasta_common:
+        reset_derived()
+    cache = common('derived')
+    if (key, small) in cache:
+        return cache[(key, small)]
+    func, deps = Derived_func[key]
+    for d in deps:
+        Get_derived(dat, d, small)
+    if small:
+        verb(f'    Deriving {key} at original resolution')
+    else:
+        verb(f'    Deriving {key}')
+    stack = common('derived_stack')
+    stack.append(0)     #time spent on fields derived within this one, so it isn't counted twice
+    start = time.perf_counter()
+    out = func(dat, small)
+    took = time.perf_counter() - start
+    inner = stack.pop()
+    if stack:
+        stack[-1] += took
+    if not isinstance(out, dict):
+        out = {key: out}
+    for k, v in out.items():
+        cache[(k, small)] = v
+    common('derived_log').append((key, small, took - inner))
+    return cache[(key, small)]
+
+#Report which derived fields were computed and the time taken for each
+# returns list of (key, original resolution, seconds)
+def Derived_report():
+    try:
+        log = common('derived_log')
+    except:
+        return []
+    if log:
+        verb(f'   Derived {len(log)} fields in {sum(l[2] for l in log):.2f} s:')
+        for k, small, took in log:
+            verb(f'    {k}{" (original resolution)" if small else ""}: {took:.3f} s')
+    return log
+
+#Temperature in K without topographic adjustment, along with the adjustment map
+def Derive_tas(dat, no_interp):
+    if no_interp:
+        return dict(tas_k=Get_nc(dat, 'tas', no_interp=True), adjust=0)
+    tas, adjust = Get_nc_adjust(dat, 'tas', 'grnz', t_unadjust=True)
+    return dict(tas_k=tas, adjust=adjust)
+
+#Surface temperature in K without topographic adjustment
+def Derive_ts(dat, no_interp):
+    return Get_nc(dat, 'ts', no_interp=no_interp)
+
+#Difference from surface to 2-meter air temperature, to apply to maxt and mint
+def Derive_tdif(dat, no_interp):
+    if opt('temp_adjust_ts'):
+        verb('    Finding adjustment from surface temp to 2-meter air temp')
+        return Get_derived(dat, 'tas_k', no_interp) - Get_derived(dat, 'ts_k', no_interp)
+    return 0
+
+#Temperature in C with topographic adjustment
+def Derive_temp_c(key):
+    def derive(dat, no_interp):
+        return Get_derived(dat, key, no_interp) + Get_derived(dat, 'adjust', no_interp) + opt('temp_adjust')
+    return derive
+
+#Daily temperature extremes in K adjusted to 2-meter air temperature, without topographic adjustment
+def Derive_ext(key, ext):
+    def derive(dat, no_interp):
+        return Get_nc(dat, key, no_interp=no_interp, bin_ext=ext) + Get_derived(dat, 'tdif', no_interp)
+    return derive
+
+#Variable straight from the files without further processing
+def Derive_raw(key, low=False, optional=False):
+    def derive(dat, no_interp):
+        try:
+            return Get_nc(dat, key, no_interp=no_interp, low=low)
+        except:
+            if optional:
+                return None
+            raise
+    return derive
+
+#Precipitation in mm/month
+def Derive_pr(dat, no_interp):
+    return Get_derived(dat, 'pr_raw', no_interp) * opt('precip_adjust')
+
+#Incident surface radiation in W/m^2
+def Derive_rin(dat, no_interp):
+    return Get_derived(dat, 'rss', no_interp) - Get_derived(dat, 'ssru', no_interp)
+
+#PET in mm/month from temperatures with topographic adjustment
+def Derive_pet(dat, no_interp):
+    return Get_pet(dat, {'adjust': Get_derived(dat, 'adjust', no_interp)}, no_interp=no_interp)
+
+#PET in mm/month from temperatures without topographic adjustment
+# because adjustments can't be applied to evap, adjusting only PET would have weird effects on Ar
+def Derive_pet_unadj(dat, no_interp):
+    if no_interp:
+        return Get_derived(dat, 'pet', True)
+    temps = {'tas': Get_derived(dat, 'tas_k') + opt('temp_adjust')}
+    if opt('temp_tunings') == 'tavg':   #no absolute temperature data; ignore diurnal variation
+        temps['maxt'] = temps['mint'] = None
+    else:
+        temps['maxt'] = Get_derived(dat, 'maxt_k') + opt('temp_adjust')
+        temps['mint'] = Get_derived(dat, 'mint_k') + opt('temp_adjust')
+    return Get_pet(dat, temps)
+
+#Evapotranspiration in mm/month, either from files or estimated from PET and precipitation
+def Derive_evap(dat, no_interp):
+    if opt('estimate_evap') == 'all' or (opt('interp_scale') and opt('estimate_evap') == 'sea'):
+        if not no_interp and opt('interp_scale'):
+            return Interp(Get_derived(dat, 'evap', True))
+        verb('    Gathering data to estimate evapotranspiration')
+        evap = Estimate_evap(Get_derived(dat, 'pet', True), Get_derived(dat, 'pr', True))  #estimate evaporation from pet and pr at original resolution
+        if opt('estimate_evap') == 'sea':
+            verb('    Combining evap data for land with estimated evap for sea')
+            evap_land = Get_nc(dat, 'evap', no_interp = True) * -opt('precip_adjust')   #convert from m/s to mm/month (and flip sign)
+            evap = np.where(get_mask(dat, 'lsm', convert=True), evap_land, evap)    #apply evap estimation only to sea areas
+        return evap
+    return Get_nc(dat, 'evap', no_interp=no_interp) * -opt('precip_adjust')   #convert from m/s to mm/month (and flip sign)
+
+#Snow and ice thickness in m, capped to help get smoother interpolation
+def Derive_ice(dat, no_interp):
+    if opt('interp_scale') and not no_interp:
+        return Interp(Get_derived(dat, 'ice', True))
+    return np.minimum(Get_nc(dat, 'snd', no_interp=True, bin_ext=-1), 0.4)
+
+#Proportional sea ice cover
+def Derive_sic(dat, no_interp):
+    return Get_nc(dat, 'sic', no_interp=no_interp, dummy_ice=opt('dummy_ice'))
+
+Derived_func['tas_k'] = Derived_func['adjust'] = (Derive_tas, ())
+Derived_func['ts_k'] = (Derive_ts, ())
+Derived_func['tdif'] = (Derive_tdif, ('tas_k',))
+Derived_func['tas'] = (Derive_temp_c('tas_k'), ('tas_k', 'adjust'))
+Derived_func['ts'] = (Derive_temp_c('ts_k'), ('ts_k', 'adjust'))
+Derived_func['maxt_k'] = (Derive_ext('maxt', 1), ('tdif',))
+Derived_func['mint_k'] = (Derive_ext('mint', -1), ('tdif',))
+Derived_func['maxt'] = (Derive_temp_c('maxt_k'), ('maxt_k', 'adjust'))
+Derived_func['mint'] = (Derive_temp_c('mint_k'), ('mint_k', 'adjust'))
+Derived_func.update({k: (Derive_raw(k), ()) for k in ('rss', 'rls', 'ps', 'ssru', 'tso')})
+Derived_func['pr_raw'] = (Derive_raw('pr'), ())
+Derived_func['hur'] = (Derive_raw('hur', low=True), ())
+Derived_func['spd'] = (Derive_raw('spd', low=True), ())
+Derived_func['vegf'] = (Derive_raw('vegf', optional=True), ())
+Derived_func['pr'] = (Derive_pr, ('pr_raw',))
+Derived_func['rin'] = (Derive_rin, ('rss', 'ssru'))
+Derived_func['pet'] = (Derive_pet, ('tas', 'adjust'))
+Derived_func['pet_unadj'] = (Derive_pet_unadj, ('tas_k',))
+Derived_func['evap'] = (Derive_evap, ())
+Derived_func['ice'] = (Derive_ice, ())
+Derived_func['sic'] = (Derive_sic, ())
+
 #Produce debug netcdf file with arrays in data, param, clim, and common
 # returns debug file name
 def Debug_file(data, params):
@@ -3294,6 +3770,7 @@ def Debug_file(data, params):
     else:
         name = 'output_debug.nc'
     debug = nc.Dataset(name, 'w')
+    ftype = np.dtype(opt('precision') or 'f8').str[1:]  #save data arrays at working precision
     for k, v in data.items():   #I'm starting to wonder if there's a better way to just pull the first entry in a dictionary, but eh
         sh = v.shape
         break
@@ -3320,7 +3797,7 @@ def Debug_file(data, params):
             if v.shape[-1] != len(lon):
                 if lat_big is None:
                     lat_big, lon_big = get_coords((v.shape[-2], v.shape[-1]), big=True)
-                    lat_big *= 180/math.pi
+                    lat_big = lat_big * 180/math.pi
                     lon_big = lon_big * 180/math.pi
                     for dim, n in zip((lat_big, lon_big), ('lat','lon')):
                         newdim = debug.createDimension(n, len(dim))
@@ -3329,10 +3806,10 @@ def Debug_file(data, params):
                 latdim = 'lat'
                 londim = 'lon'
             if v.ndim == 3:
-                newvar = debug.createVariable(k,'f8',('time',latdim,londim),compression='zlib', complevel=9)
+                newvar = debug.createVariable(k,ftype,('time',latdim,londim),compression='zlib', complevel=9)
                 newvar[:(v.shape[0]),:,:] = v[:]
             else:
-                newvar = debug.createVariable(k,'f8',(latdim,londim),compression='zlib', complevel=9)
+                newvar = debug.createVariable(k,ftype,(latdim,londim),compression='zlib', complevel=9)
                 newvar[:] = v[:]
         except:
             print(f'  Could not save {k} to debug file')
@@ -3348,9 +3825,9 @@ def Debug_file(data, params):
                 latdim = 'lat'
                 londim = 'lon'
             if m == 'lapse':
-                newvar = debug.createVariable(m,'f8',('time',latdim,londim),compression='zlib', complevel=9)
+                newvar = debug.createVariable(m,ftype,('time',latdim,londim),compression='zlib', complevel=9)
             else:
-                newvar = debug.createVariable(m,'f8',(latdim,londim),compression='zlib', complevel=9)
+                newvar = debug.createVariable(m,ftype,(latdim,londim),compression='zlib', complevel=9)
             newvar[:] = var[:]
         except:
             continue
@@ -3382,7 +3859,7 @@ def Alternate_Data():
     dat = nc.Dataset('TerraClimate19812010_tmax.nc')
     maxt = dat['tmax'][:]
     dat.close()
-    rin = Estimate_rad(np.ones([maxt.shape[0],int(maxt.shape[1]/fac),int(maxt.shape[2]/fac)]))
+    rin = Estimate_rad(np.empty([maxt.shape[0],int(maxt.shape[1]/fac),int(maxt.shape[2]/fac)]))   #only shape is used
     
     dat = nc.Dataset('TerraClimate19812010_tmin.nc')
     mint = dat['tmin'][:]
@@ -3434,6 +3911,287 @@ def Alternate_Data():
     return all_data
     
 
+#Extract data from a single file and process to climate parameters, for param file combination
+# returns the parameter dictionary, and the data dictionary (or None if run in a worker process and not needed for debug file)
+#   f: input file name
+#   land_funcs, sea_funcs: lists of appropriate climate functions from Clim_func
+#   multi: processing one file of several
+#   buf: contents of file already read into memory, if prefetched
+def Param_file(f, land_funcs, sea_funcs, multi=True, buf=None):
+    verb(f'   Extracting from {f}')
+    if buf is not None:
+        dat = nc.Dataset(f, memory=buf)
+    else:
+        dat = nc.Dataset(f)
+    try:
+        coords_from_file(dat,'lat','lon') #try to ensure coords read from file for eps inputs
+    except:
+        pass
+    reset_derived()     # derived data is shared between land, sea, and extra functions for each file
+    verb('   Extracting data for land')
+    data = land_funcs[0]([dat])
+    verb('   Extracting data for sea')
+    data = sea_funcs[0]([dat], data)    # sea functions take data output from land function and add to it
+    verb('   Extracting any necessary extra data')
+    data = Extra_Data([dat], data)  # extra data functions run in all cases
+    Derived_report()
+    reset_derived()
+    dat.close()
+    if opt('seasonless'):
+        for k, v in data.items():
+            if v.ndim > 2:
+                data[k] = np.mean(v, 0, keepdims=True)  # for seasonless zones, average along time axis but keep dimension
+    verb(f'   Extracted data contains {[k for k,v in data.items()]}')
+    if not multi:
+        print(" Processing data to climate parameters...")
+    par = Calc_params(data, land_funcs, sea_funcs)
+    if kpasta_common.get('worker') and not opt('debug_file'):
+        data = None     # avoid sending data back from worker processes when it won't be used
+    return par, data
+
+#Set up options and common data in worker processes for parallel param file combination
+#   options: options dictionary from main process
+#   shared: common data dictionary from main process
+def Init_worker(options, shared):
+    global kpasta_options
+    global kpasta_common
+    kpasta_options = options
+    kpasta_common = dict(shared)
+    kpasta_common['worker'] = True
+
+#Options that don't affect climate parameters, so are left out of the cache key
+cache_ignore_opts = ('warm_reuse', 'land_color', 'sea_color', 'color_file', 'make_key', 'make_chart', 'outname', 'image_scale', 'font_size',
+                     'debug_file', 'verbose', 'efficient', 'stream_files', 'param_processes', 'prefetch_files', 'cache_dir', 'cache_size',
+                     'compress_cells', 'use_numba', 'key_area', 'image_palette', 'save_image', 'make_stats', 'stats_band', 'animate', 'frame_time')
+
+#Find key for saving climate parameters to cache
+# returns hash string of input files, _Data and _Param functions, and options they may read,
+#  so runs only changing options used in determining zones (e.g. thresholds or land_subtype for most types) can reuse parameters
+#   files: list of netcdf files
+#   land_funcs, sea_funcs: lists of appropriate climate functions from Clim_func
+def Cache_key(files, land_funcs, sea_funcs):
+    key = []
+    for f in files + [opt('topo_map')]:
+        if f is not None and os.path.exists(f):     #missing topography map is ignored, as in the rest of the script
+            st = os.stat(f)
+            key.append((os.path.abspath(f), st.st_size, st.st_mtime_ns))    #files identified by size and modification time
+    funcs = list(land_funcs[:2]) + list(sea_funcs[:2])
+    key.append([func.__name__ for func in funcs])
+    used = (find_opts([Get_params] + funcs) | set(warm_opts)) - set(cache_ignore_opts)
+    key.append(sorted((k, repr(opt(k))) for k in used if k in kpasta_options))
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+#Load climate parameters and common data from cache
+# returns dictionary of climate parameters, or None if not in cache
+#   cache_key: key from Cache_key()
+def Load_cache(cache_key):
+    name = os.path.join(opt('cache_dir'), cache_key + '.npz')
+    if not os.path.exists(name):
+        return None
+    print(f" Loading climate parameters from {name}...")
+    try:
+        params = {}
+        with np.load(name) as cache:
+            tuples = list(cache['tuple_keys']) if 'tuple_keys' in cache else []
+            for k in (cache['none_keys'] if 'none_keys' in cache else []):
+                params[k] = None    #parameters that weren't found
+            for k in cache.files:
+                if k.startswith('par/'):
+                    params[k[4:]] = cache[k]
+                elif k.startswith('com/'):
+                    v = cache[k]
+                    if k[4:] in tuples:
+                        v = tuple(v.tolist())
+                    elif v.ndim == 0:
+                        v = v.item()
+                    kpasta_common[k[4:]] = v
+        os.utime(name)  #mark as recently used
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+        print(f"  Couldn't read cache file ({e}); extracting data instead")
+        return None
+    return params
+
+#Save climate parameters and common data to cache, then remove least recently used files if cache is too large
+#   cache_key: key from Cache_key()
+#   params: dictionary of climate parameters
+def Save_cache(cache_key, params):
+    os.makedirs(opt('cache_dir'), exist_ok=True)
+    name = os.path.join(opt('cache_dir'), cache_key + '.npz')
+    out = {'par/'+k: np.asarray(v) for k, v in params.items() if v is not None}
+    out['none_keys'] = np.array([k for k, v in params.items() if v is None], dtype=str)  #None can't be saved without pickling
+    tuples = []
+    for k, v in kpasta_common.items():
+        if k.startswith('derived') or k in ('colmap', 'worker') or v is None:
+            continue
+        v_arr = np.asarray(v)
+        if v_arr.dtype == object:   #can't be saved without pickling
+            continue
+        if isinstance(v, tuple):
+            tuples.append(k)
+        out['com/'+k] = v_arr
+    out['tuple_keys'] = np.array(tuples, dtype=str)
+    try:
+        np.savez_compressed(name, **out)
+        verb(f'  Saved climate parameters to {name}')
+    except (OSError, ValueError) as e:
+        print(f"  Couldn't save climate parameters to {name} ({e})")
+        return
+    cached = [os.path.join(opt('cache_dir'), f) for f in os.listdir(opt('cache_dir')) if f.endswith('.npz')]
+    cached.sort(key=os.path.getmtime)
+    total = sum(os.path.getsize(f) for f in cached)
+    while cached and total > opt('cache_size') * 1e6:
+        f = cached.pop(0)
+        total -= os.path.getsize(f)
+        verb(f'  Removing {f} from cache')
+        os.remove(f)
+
+#Options that affect common and derived data; runs with the same files and these options can reuse that data
+warm_opts = ('file_combine', 'bin_months', 'bin_preserve_ext', 'interp_scale', 'interp_type', 'dummy_ice', 'topo_map', 'maxel', 'minel', 'sealev', 'gravity',
+             'lapse_threshold', 'const_lapse_rate', 'temp_adjust', 'precip_adjust', 'pet_method', 'pet_backup_ps', 'pet_backup_wind', 'pet_gascon',
+             'pet_use_vegf', 'estimate_evap', 'temp_tunings', 'temp_adjust_ts', 'region', 'region_halo', 'precision')
+
+#Find signature of files and options for reusing data between runs
+# returns string to compare with kpasta_warm['sig']
+#   files: list of netcdf files
+def warm_sig(files):
+    key = [(os.path.abspath(f), os.path.getmtime(f)) for f in files]
+    key.append([(k, opt(k)) for k in warm_opts])
+    key.append(opt('sea_type') == 'sea_none')     #land/sea mask is filled in with sea_none
+    return repr(key)
+
+#Restore common data from previous run, if it used the same files and relevant options
+# returns derived data dictionary from previous run (empty if it can't be reused)
+#   files: list of netcdf files
+def Warm_start(files):
+    if not opt('warm_reuse') or kpasta_warm.get('sig') != warm_sig(files):
+        return {}
+    print("  Reusing data from previous run with same files")
+    for k, v in kpasta_warm['common'].items():
+        if k not in kpasta_common:
+            kpasta_common[k] = v
+    return dict(kpasta_warm['derived'])
+
+#Keep common data and derived data for reuse in later runs with the same files
+#   files: list of netcdf files
+#   derived: derived data dictionary to keep
+def Warm_save(files, derived={}):
+    kpasta_warm.clear()
+    if not opt('warm_reuse'):
+        return
+    kpasta_warm['sig'] = warm_sig(files)
+    kpasta_warm['common'] = {k: v for k, v in kpasta_common.items() if not k.startswith('derived') and k not in ('colmap', 'worker')}
+    kpasta_warm['derived'] = dict(derived)
+
+#Retrieve data from all files together, using data or seq file combination
+# returns dictionary of climate data
+#   files: list of netcdf files
+#   land_funcs, sea_funcs: lists of appropriate climate functions from Clim_func
+def Get_data(files, land_funcs, sea_funcs):
+    if opt('force_alt_data'):
+        print(" Using alternate data collection function...")
+        if opt('file_combine') != 'data':
+            print("  Note: file combination method may not be applied")
+        data = Alternate_Data()
+        if opt('precision'):
+            data = {k: v.astype(opt('precision'), copy=False) if isinstance(v, np.ndarray) and v.dtype.kind == 'f' else v for k, v in data.items()}
+    else:
+        if opt('file_combine') == 'seq' and len(files) > 1:
+            print("  Linking data across files into single year")
+        if opt('stream_files'):
+            dats = list(files)  # files opened one at a time by Read_nc() as needed, to avoid holding many open at once
+            with nc.Dataset(files[0]) as dat:
+                coords_from_file(dat,'lat','lon') #try to ensure coords read from file for eps inputs
+        else:
+            dats = [nc.Dataset(f) for f in files]     # average data across years, then determine parameters
+            #try:
+            coords_from_file(dats[0],'lat','lon') #try to ensure coords read from file for eps inputs
+            #except:
+            #    pass
+        reset_derived()
+        kpasta_common['derived'] = Warm_start(files)
+        verb('   Extracting data for land')
+        data = land_funcs[0](dats)
+        verb('   Extracting data for sea')
+        data = sea_funcs[0](dats, data)
+        verb('   Extracting any necessary extra data')
+        data = Extra_Data(dats, data)  
+        Derived_report()
+        Warm_save(files, common('derived'))
+        reset_derived()
+    return data
+
+#Process data to climate parameters with land, sea, and extra _Param functions
+# with compress_cells option, land and sea cells are gathered into separate compact arrays, so land parameters are only found for land cells and sea for sea,
+#  then scattered back into full maps, with parameters missing from one set of cells left as 0 there
+# returns dictionary of climate parameters
+#   data: dictionary of climate data
+#   land_funcs, sea_funcs: lists of appropriate climate functions from Clim_func
+def Calc_params(data, land_funcs, sea_funcs):
+    mask = None
+    if opt('compress_cells') and opt('blend') and opt('sea_type') != 'sea_none':
+        for k in ('mask_topo', 'mask_big', 'mask'):   #same order of masks as Get_clims
+            if k in kpasta_common:
+                mask = np.asarray(common(k))
+                if mask.ndim > 2:
+                    mask = mask[0]
+                break
+        shape = None
+        for v in data.values():
+            if v.ndim > 2:
+                shape = v.shape[1:]
+                break
+        if mask is None or mask.shape != shape:
+            verb('   No land/sea mask matching data found; not compressing cells')
+            mask = None
+    if mask is None:
+        verb('   Calculating parameters for land')
+        params = land_funcs[1](data)
+        verb('   Calculating parameters for sea')
+        params = sea_funcs[1](data, params)
+        verb('   Calculating any necessary extra parameters')
+        params = Extra_Param(data, params)
+        return params
+    
+    land = np.flatnonzero(mask)
+    sea = np.flatnonzero(mask == 0)
+    verb(f'   Compressing data to {len(land)} land cells and {len(sea)} sea cells')
+    verb('   Calculating parameters for land')
+    land_data = gather_cells(data, land, shape)
+    land_par = land_funcs[1](land_data)
+    land_par = sea_funcs[1](land_data, land_par)    #sea parameters found for land cells too, as they would be overwritten in land parameters otherwise
+    land_par = Extra_Param(land_data, land_par)
+    del land_data
+    verb('   Calculating parameters for sea')
+    sea_data = gather_cells(data, sea, shape)
+    sea_par = sea_funcs[1](sea_data, {})
+    sea_par = Extra_Param(sea_data, sea_par)
+    del sea_data
+    verb('   Scattering parameters back to map')
+    params = {}
+    for cells, par in ((land, land_par), (sea, sea_par)):
+        for k, v in par.items():
+            if not isinstance(v, np.ndarray) or v.ndim < 2 or v.shape[-2:] != (1, len(cells)):
+                params[k] = v   #not a map of cells
+                continue
+            if k not in params:
+                params[k] = np.zeros(v.shape[:-2] + shape, dtype=v.dtype)
+            params[k].reshape(v.shape[:-2] + (-1,))[..., cells] = v[..., 0, :]
+    return params
+
+#Gather cells of data arrays into (1, cells) arrays, or (time, 1, cells) for time series
+# arrays of other shapes are left as is
+#   data: dictionary of climate data
+#   cells: flat indices of cells to gather
+#   shape: (y,x) shape of map
+def gather_cells(data, cells, shape):
+    out = {}
+    for k, v in data.items():
+        if v.ndim > 1 and v.shape[-2:] == shape:
+            out[k] = np.take(v.reshape(v.shape[:-2] + (-1,)), cells, -1)[..., None, :]  #take gives contiguous output, keeping per-month slices fast
+        else:
+            out[k] = v
+    return out
+
 #Standard function to retrieve data and determine parameters
 # returns dictionary of climate parameters
 #   files: list of netcdf files
@@ -3450,61 +4208,45 @@ def Get_params(files, land_funcs, sea_funcs):
             print("  Extracting and processing data to climate parameters per-file before averaging")
         if opt('seasonless'):
             print("  Averaging data across months to produce seasonless climate")
-        for f in files:         # determine parameters for each year before averaging together
-            verb(f'   Extracting from {f}')
-            dat = nc.Dataset(f)
-            try:
-                coords_from_file(dat,'lat','lon') #try to ensure coords read from file for eps inputs
-            except:
-                pass
-            verb('   Extracting data for land')
-            data = land_funcs[0]([dat])
-            verb('   Extracting data for sea')
-            data = sea_funcs[0]([dat], data)    # sea functions take data output from land function and add to it
-            verb('   Extracting any necessary extra data')
-            data = Extra_Data([dat], data)  # extra data functions run in all cases
-            if opt('seasonless'):
-                for k, v in data.items():
-                    if v.ndim > 2:
-                        data[k] = np.mean(v, 0, keepdims=True)  # for seasonless zones, average along time axis but keep dimension
-            verb(f'   Extracted data contains {[k for k,v in data.items()]}')
-            if len(files) == 1:
-                print(" Processing data to climate parameters...")
-            verb('   Calculating parameters for land')
-            par = land_funcs[1](data)
-            verb('   Calculating parameters for sea')
-            par = sea_funcs[1](data, par)
-            verb('   Calculating any necessary extra parameters')
-            Extra_Param(data, par)  #extra parameter functions
-            if params:
-                for k,p in params.items():
-                    params[k] = params[k] + par[k]
-            else:
-                params = par
-            verb(f'   Calculated parameters are {[k for k,v in params.items()]}')
+        Warm_start(files)   #derived data isn't kept between files, but common data can be reused
+        if opt('param_processes') > 1 and len(files) > 2:
+            par, data = Param_file(files[0], land_funcs, sea_funcs)     #first file processed here so common data (coords, mask, etc.) is available afterward
+            params = par
+            print(f"  Processing remaining files in {min(opt('param_processes'), len(files)-1)} parallel processes")
+            shared = {k: v for k, v in kpasta_common.items() if not k.startswith('derived')}
+            n = len(files) - 1
+            with ProcessPoolExecutor(min(opt('param_processes'), n), initializer=Init_worker, initargs=(kpasta_options, shared)) as pool:
+                for par, p_data in pool.map(Param_file, files[1:], [land_funcs]*n, [sea_funcs]*n):
+                    for k,p in params.items():      # summed in file order, so result is the same as processing in sequence
+                        params[k] = params[k] + par[k]
+                    if p_data is not None:
+                        data = p_data
+        else:
+            prefetch = opt('prefetch_files') and len(files) > 1
+            with ThreadPoolExecutor(1) as pool:     #only reads raw files, as netcdf library isn't used outside main thread; no thread started unless prefetching
+                if prefetch:
+                    verb('   Prefetching each file while processing the previous one')
+                    next_buf = pool.submit(Read_file, files[0])
+                for i, f in enumerate(files):         # determine parameters for each year before averaging together
+                    buf = None
+                    if prefetch:
+                        buf = next_buf.result()
+                        if i + 1 < len(files):
+                            next_buf = pool.submit(Read_file, files[i+1])
+                    par, data = Param_file(f, land_funcs, sea_funcs, len(files) > 1, buf)
+                    del buf
+                    if params:
+                        for k,p in params.items():
+                            params[k] = params[k] + par[k]
+                    else:
+                        params = par
+                    verb(f'   Calculated parameters are {[k for k,v in params.items()]}')
         for k,p in params.items():
             params[k] = params[k] / len(files)
+        Warm_save(files)
         
     else:
-        if opt('force_alt_data'):
-            print(" Using alternate data collection function...")
-            if opt('file_combine') != 'data':
-                print("  Note: file combination method may not be applied")
-            data = Alternate_Data()
-        else:
-            if opt('file_combine') == 'seq' and len(files) > 1:
-                print("  Linking data across files into single year")
-            dats = [nc.Dataset(f) for f in files]     # average data across years, then determine parameters
-            #try:
-            coords_from_file(dats[0],'lat','lon') #try to ensure coords read from file for eps inputs
-            #except:
-            #    pass
-            verb('   Extracting data for land')
-            data = land_funcs[0](dats)
-            verb('   Extracting data for sea')
-            data = sea_funcs[0](dats, data)
-            verb('   Extracting any necessary extra data')
-            data = Extra_Data(dats, data)  
+        data = Get_data(files, land_funcs, sea_funcs)
         if opt('seasonless'):
             print("  Averaging data across months to produce seasonless climate")
             for k, v in data.items():
@@ -3515,12 +4257,7 @@ def Get_params(files, land_funcs, sea_funcs):
             print(" Processing averaged data from all files to climate parameters...")
         else:
             print(" Processing data to climate parameters...")
-        verb('   Calculating parameters for land')
-        params = land_funcs[1](data)
-        verb('   Calculating parameters for sea')
-        params = sea_funcs[1](data, params)
-        verb('   Calculating any necessary extra parameters')
-        params = Extra_Param(data, params)
+        params = Calc_params(data, land_funcs, sea_funcs)
         verb(f'   Calculated parameters are {[k for k,v in params.items()]}')
     if opt('debug_file'):
         print(" Making debug file...")
@@ -3559,6 +4296,7 @@ def Get_clims(params, land_funcs, sea_funcs):
                             break
     land_clims = np.zeros(mask.shape,dtype=np.uint16)
     sea_clims = np.zeros(mask.shape,dtype=np.uint16)
+    add_common('clim_mask', np.where(mask, True, False))    #saved for splitting zone statistics by land and sea
     par = {}
     if opt('blend') and opt('sea_type') != ('sea_none'):    #make masks of where to find land and sea climates
         do_land = np.where(mask, True, False)
@@ -3740,6 +4478,25 @@ def Get_colmap():
         add_common('colmap', colmap)
     return colmap
 
+#Find portion of total surface area in each cell of map, presuming evenly spaced latitude rows from north to south
+# for maps of a region, finds portion of region's area instead
+# returns weight array and latitude of each row in degrees
+#   shape: (y,x) shape of map
+def area_weight(shape):
+    lat = 90 - (np.arange(shape[0]) + 0.5) / shape[0] * 180
+    if 'res_full' in kpasta_common and tuple(shape) == tuple(common('res')):
+        lat = common('lat_big') * 180/math.pi     #region covers only some latitudes
+    cos = np.cos(lat*math.pi/180)
+    weight = np.broadcast_to(cos[:,None], shape) / (np.sum(cos) * shape[1])
+    return weight, lat
+
+#Find name to use for a climate zone id
+def zone_name(z):
+    names = zone_index.get(z)
+    if not names:
+        return str(z)
+    return name_key.get(z, names[0][1])
+
 #Attempt to produce image key of all climates in maps using colmap
 def Make_key(maps, colmap=None):
 
@@ -3747,21 +4504,24 @@ def Make_key(maps, colmap=None):
         colmap = Get_colmap()
 
     verb('     Finding all used climate zones')
-    keys = []
-    for k, v in maps.items():   #finds all climate zone types used in maps
-        for x in np.nditer(v):
-            if x not in keys:
-                keys.append(x)
+    counts = 0
+    area = 0
+    for k, v in maps.items():   #finds all climate zone types used in maps, and area covered by each
+        weight = area_weight(v.shape)[0]
+        counts = counts + np.bincount(v.ravel(), minlength=65536)
+        area = area + np.bincount(v.ravel(), weights=weight.ravel(), minlength=65536)
+    keys = np.flatnonzero(counts)
     
     verb('   Finding names for climate zones')
+    entries = []
+    for v in keys:      #attempts to find names for each climate from index of global variables
+        for i, k in zone_index.get(v, []):
+            entries.append((i, name_key.get(v, k), v))
     zones = {}
-    glob = list(globals().items())
-    for k, v in glob:    #attempts to find names for each climate by searching global variables
-        if type(v) is int and v in keys:
-            try:
-                zones[name_key[v]] = v
-            except:
-                zones[k] = v
+    for i, k, v in sorted(entries):
+        if opt('key_area'):
+            k = f'{k} ({area[v]*100:.1f}%)'
+        zones[k] = v
     
     verb(f'   Found {len(keys)} zones, constructing key image')
     key_im = Image.new(mode="RGB", size=(1000,len(zones)*25+5), color=(0,0,0))
@@ -3833,38 +4593,42 @@ def Make_chart(clim, par):
     pco = 19 + plen - np.round((pr-pmin))
 
     verb('    Charting points on map by average climate')
-    points = {}
-    for x in range(clim.shape[0]):
-        for y in range(clim.shape[1]):
-            if clim[x,y] > 0:
-                ind = str(int(tco[x,y]))+','+str(int(pco[x,y]))
-                try:
-                    points[ind].append(clim[x,y])   #assemble list of climates on each point
-                except:
-                    points[ind] = [clim[x,y]]
-    verb(f'     Charted {clim.shape[0] * clim.shape[1]} map points to {len(points)} chart pixels, coloring by most common climate zone')
-    for k, v in points.items():
-        co = k.split(',')
-        if len(v) == 1:
-            col = tuple(colmap[v[0]])   #if one color on point, use that
-        else:
-            alts = [0]
-            curmax = 0
-            for c in v:
-                if c not in alts:
-                    count = v.count(c)  #count occurances of each climate type and assemble list of most common types
-                    if count > curmax:
-                        alts = [c]
-                        curmax = count
-                    elif count == curmax:
-                        alts.append(c)
-            col = tuple(colmap[alts[int(len(alts)/2)]]) #if one winner, use that climate, if multiple, pick from middle of list
-        im.point((int(co[0]),int(co[1])), fill=col)
+    use = clim > 0
+    tco = tco[use].astype(int)  #points in same order as map, row by row
+    pco = pco[use].astype(int)
+    zones, zind = np.unique(clim[use], return_inverse=True)
+    inside = (tco >= 0) & (tco < chart_im.width) & (pco >= 0) & (pco < chart_im.height)
+    pix = (pco * chart_im.width + tco)[inside]  #index of chart pixel for each point
+    zind = zind.ravel()[inside]
+    pairs, first, count = np.unique(pix * len(zones) + zind, return_index=True, return_counts=True)  #count of each zone on each pixel, and first point where it appears
+    p_pix = pairs // len(zones)
+    starts = np.flatnonzero(np.r_[True, p_pix[1:] != p_pix[:-1]])
+    maxcount = np.repeat(np.maximum.reduceat(count, starts), np.diff(np.r_[starts, len(p_pix)]))
+    top = count == maxcount     #most common zones on each pixel
+    order = np.lexsort((first[top], p_pix[top]))    #sort by pixel, then by order of appearance in map
+    t_pix = p_pix[top][order]
+    t_zone = zones[pairs[top][order] % len(zones)]
+    starts = np.flatnonzero(np.r_[True, t_pix[1:] != t_pix[:-1]])
+    lens = np.diff(np.r_[starts, len(t_pix)])
+    verb(f'     Charted {clim.shape[0] * clim.shape[1]} map points to {len(starts)} chart pixels, coloring by most common climate zone')
+    chart_dat = np.array(chart_im)
+    chart_dat.reshape(-1, 3)[t_pix[starts]] = colmap[t_zone[starts + lens//2]]    #if one winner, use that climate, if multiple, pick from middle of list
+    chart_im = Image.fromarray(chart_dat)
         
     
     return chart_im
         
 
+#Apply image_scale option to image
+def scale_image(outim):
+    if opt('image_scale'):
+        scale = opt('image_scale')
+        if type(scale) is not tuple:
+            scale = (round(outim.size[0]*scale),round(outim.size[1]*scale))
+        verb(f'   Scaling output image to {scale}')
+        outim = outim.resize(scale, resample=Image.Resampling.NEAREST)
+    return outim
+
 #Convert climate arrays to color images
 #   maps: dictionary containing arrays of climate zones
 def Make_image(maps, outname=None, in_opts = None):
@@ -3878,18 +4642,18 @@ def Make_image(maps, outname=None, in_opts = None):
     colmap = Get_colmap()
     print(' Outputting climate zone map...')
     for k, v in maps.items():
-        outmap = np.empty((v.shape[0],v.shape[1],3), dtype=np.uint8)    # note dimensions switched from (lat,lon) to (x,y)
-        for x in range(v.shape[1]):
-            for y in range(v.shape[0]):     # maybe someday I'll properly implement a numpy indexing routine
-                clim = v[y,x]
-                outmap[y,x,:] = colmap[clim]
-        outim = Image.fromarray(outmap)
-        if opt('image_scale'):
-            scale = opt('image_scale')
-            if type(scale) is not tuple:
-                scale = (round(outim.size[0]*scale),round(outim.size[1]*scale))
-            verb(f'   Scaling output image to {scale}')
-            outim = outim.resize(scale, resample=Image.Resampling.NEAREST)
+        used = None
+        if opt('image_palette'):
+            used = np.unique(v)
+            if len(used) > 256:
+                print('  More than 256 zones in map, so saving as RGB rather than with palette')
+                used = None
+        if used is not None:
+            outim = Image.fromarray(np.searchsorted(used, v).astype(np.uint8))    #index of each zone in used zones
+            outim.putpalette(colmap[used].flatten().tolist())   #also converts to palette image
+        else:
+            outim = Image.fromarray(colmap[v])  #color of each zone from colmap
+        outim = scale_image(outim)
         if len(maps) > 1:
             savename = outname + '_' + k + '.png'
         else:
@@ -3902,6 +4666,272 @@ def Make_image(maps, outname=None, in_opts = None):
         key_im.save(outname + '_key.png')
     return outim
 
+#Find portion of surface area covered by each zone in maps, split by land/sea and by latitude band, and save to csv or json file
+# all portions are of total surface area of map
+#   maps: dictionary containing arrays of climate zones
+#   outname: name of output file, without extension
+def Make_stats(maps, outname=None):
+    if not outname:
+        if opt('outname'):
+            outname = opt('outname')
+        else:
+            outname = 'output'
+    form = opt('make_stats')
+    if form not in ('csv', 'json'):
+        form = 'csv'
+    band = opt('stats_band')
+    print(' Finding climate zone statistics...')
+    try:
+        mask = common('clim_mask')
+    except:
+        mask = None
+    out = {}
+    for k, v in maps.items():
+        weight, lat = area_weight(v.shape)
+        if band:
+            edges = np.arange(-90, 90, band)
+            bands = np.minimum(((lat + 90) // band).astype(int), len(edges)-1)   #latitude band of each row
+        else:
+            edges = np.array([-90])
+            bands = np.zeros(v.shape[0], dtype=int)
+        labels = []
+        for lo in edges:
+            hi = min(lo + band, 90) if band else 90
+            labels.append('-'.join(f'{abs(l):g}{"S" if l < 0 else "N" if l > 0 else ""}' for l in (lo, hi)))
+        nb = len(edges)
+        if mask is None or mask.shape != v.shape:
+            land = np.full(v.shape, True)
+        else:
+            land = mask
+        verb(f'   Finding area of zones in {k} map')
+        ind = (v.astype(np.int64) * nb + bands[:,None]) * 2 + land   #combined index of zone, latitude band, and land/sea for each cell
+        area = np.bincount(ind.ravel(), weights=weight.ravel(), minlength=(int(v.max())+1)*nb*2).reshape((-1, nb, 2))
+        zones = {}
+        for z in np.flatnonzero(np.bincount(v.ravel())):
+            zones[zone_name(z)] = dict(
+                id=int(z),
+                area=float(area[z].sum()),
+                land=float(area[z,:,1].sum()),
+                sea=float(area[z,:,0].sum()),
+                bands={l: float(a) for l, a in zip(labels, area[z].sum(1))}
+                )
+        out[k] = zones
+    savename = outname + '_stats.' + form
+    print(f'  Saving to {savename}')
+    if form == 'json':
+        with open(savename, 'w') as f:
+            json.dump(out, f, indent=1)
+    else:
+        with open(savename, 'w') as f:
+            f.write(','.join(['map', 'zone', 'id', 'area', 'land', 'sea'] + labels) + '\n')
+            for k, zones in out.items():
+                for name, z in zones.items():
+                    vals = [z['area'], z['land'], z['sea']] + list(z['bands'].values())
+                    f.write(','.join([k, f'"{name}"', str(z['id'])] + [f'{a:.6g}' for a in vals]) + '\n')
+    return out
+
+#Start animation of zone maps, saved as outname.gif or outname.png (or outname_land, outname_sea, etc. for separate maps)
+# all frames use one palette of every zone in colmap, so that each frame can be written as soon as it's made
+# returns dictionary of animation state, to pass to Add_frame() and End_animation()
+#   pool: thread pool executor for encoding frames in background while next maps are made, managed by caller
+#   outname: name of output file, without extension
+def Start_animation(pool, outname=None):
+    if not outname:
+        if opt('outname'):
+            outname = opt('outname')
+        else:
+            outname = 'output'
+    colmap = Get_colmap()
+    zones = np.concatenate(([0], np.flatnonzero(np.any(colmap[1:], 1)) + 1))    #all zones with colors
+    if len(zones) > 256:
+        print('  More than 256 zones in color map; zones beyond the first 256 will be black in animation')
+        zones = zones[:256]
+    lut = np.zeros(65536, dtype=np.uint8)
+    lut[zones] = np.arange(len(zones))  #index of each zone in palette
+    anim = dict(
+        outname=outname,
+        form='png' if opt('animate') in ('png', 'apng') else 'gif',
+        lut=lut,
+        palette=colmap[zones].flatten().tolist(),
+        files={},
+        frames={},
+        pool=pool,
+        job=None
+        )
+    return anim
+
+#Write frame to animation for each map in maps
+# gif frames are written to file immediately; png frames are kept as 8-bit palette images until End_animation()
+def Write_frame(anim, maps):
+    for k, v in maps.items():
+        outim = Image.fromarray(anim['lut'][v])
+        outim.putpalette(anim['palette'])
+        outim = scale_image(outim)
+        if anim['form'] == 'png':
+            anim['frames'].setdefault(k, []).append(outim)
+            continue
+        if k not in anim['files']:
+            if len(maps) > 1:
+                savename = anim['outname'] + '_' + k + '.gif'
+            else:
+                savename = anim['outname'] + '.gif'
+            print(f'  Saving animation to {savename}')
+            f = open(savename, 'wb')
+            for c in GifImagePlugin.getheader(outim, info={'loop': 0, 'optimize': False})[0]:
+                f.write(c)
+            anim['files'][k] = f
+        for c in GifImagePlugin.getdata(outim, duration=opt('frame_time')):
+            anim['files'][k].write(c)
+
+#Add maps to animation as next frame
+# waits for the previous frame to be written first, so no more than one frame waits in memory
+#   anim: animation from Start_animation()
+#   maps: dictionary containing arrays of climate zones
+def Add_frame(anim, maps):
+    if anim['job'] is not None:
+        anim['job'].result()
+    anim['job'] = anim['pool'].submit(Write_frame, anim, maps)
+
+#Finish writing animation
+def End_animation(anim):
+    if anim['job'] is not None:
+        anim['job'].result()
+    for k, f in anim['files'].items():
+        f.write(b';')   #gif trailer
+        f.close()
+    for k, frames in anim['frames'].items():
+        if len(anim['frames']) > 1:
+            savename = anim['outname'] + '_' + k + '.png'
+        else:
+            savename = anim['outname'] + '.png'
+        print(f'  Saving animation to {savename}')
+        frames[0].save(savename, save_all=True, append_images=frames[1:], duration=opt('frame_time'), loop=0)
+
+#Compare two sets of climate zone maps on the same grid
+# saves area-weighted transition matrix between zones as outname_transition.csv, with rows for zones in maps_a and columns for zones in maps_b,
+#  and a change map as outname_change.png, with changed cells in the color of their new zone and unchanged cells darkened
+# returns dictionary with tuple of zone ids and transition matrix for each map, with rows and columns in order of zone ids
+#   maps_a, maps_b: dictionaries of climate zone maps, e.g. from Make_clim, or single arrays
+#   outname: name of output files
+def Compare_maps(maps_a, maps_b, outname=None):
+    if not outname:
+        if opt('outname'):
+            outname = opt('outname')
+        else:
+            outname = 'output'
+    if isinstance(maps_a, np.ndarray):
+        maps_a = {'full': maps_a}
+    if isinstance(maps_b, np.ndarray):
+        maps_b = {'full': maps_b}
+    colmap = Get_colmap()
+    dim = colmap // 3   #darkened colors for unchanged cells
+    print(' Comparing climate zone maps...')
+    keys = [k for k in maps_a if k in maps_b]
+    trans = {}
+    for k in keys:
+        a = maps_a[k]
+        b = maps_b[k]
+        if a.shape != b.shape:
+            print(f'  {k} maps are different shapes, {a.shape} and {b.shape}; skipping comparison')
+            continue
+        verb(f'   Finding zone transitions in {k} map')
+        zones = np.flatnonzero(np.bincount(a.ravel(), minlength=65536) + np.bincount(b.ravel(), minlength=65536))    #all zones used in either map
+        n = len(zones)
+        lut = np.zeros(65536, dtype=np.int32)
+        lut[zones] = np.arange(n)   #index of each zone in zones
+        weight = area_weight(a.shape)[0]
+        mat = np.bincount((lut[a]*n + lut[b]).ravel(), weights=weight.ravel(), minlength=n*n).reshape((n, n))
+        trans[k] = (zones, mat)
+        print(f'  {np.sum(weight[a != b])*100:.1f}% of surface area changed zone in {k} map')    #summed directly, as 1 - trace can be slightly negative
+
+        if len(keys) > 1:
+            savename = outname + '_' + k
+        else:
+            savename = outname
+        print(f'  Saving transition matrix to {savename}_transition.csv')
+        names = [zone_name(z) for z in zones]
+        with open(savename + '_transition.csv', 'w') as f:
+            f.write(','.join(['from/to'] + [f'"{name}"' for name in names]) + '\n')
+            for name, row in zip(names, mat):
+                f.write(','.join([f'"{name}"'] + [f'{r:.6g}' for r in row]) + '\n')
+
+        print(f'  Saving change map to {savename}_change.png')
+        if n*2 <= 256:
+            outim = Image.fromarray((lut[b] + n*(a == b)).astype(np.uint8))    #palette image, with unchanged zones after changed ones
+            outim.putpalette(np.concatenate((colmap[zones], dim[zones])).flatten().tolist())
+        else:
+            outim = Image.fromarray(np.where((a == b)[:,:,None], dim[b], colmap[b]))
+        outim = scale_image(outim)
+        outim.save(savename + '_change.png')
+    return trans
+
+#Main routine for comparing two sets of files: classifies both with the same options, saves their outputs as outname_a and outname_b,
+# and then compares them with Compare_maps
+# files_a, files_b: name of file or list containing files for each set
+# in_opts: dictionary of options or name of config file
+def Make_compare(files_a, files_b, in_opts=None):
+    if isinstance(files_a, str):
+        files_a = File_search(files_a)
+    if isinstance(files_b, str):
+        files_b = File_search(files_b)
+    Save_opts(in_opts)
+    outname = opt('outname')
+    print('\n Making first map...')
+    maps_a = Make_clim(files_a)
+    Save_outputs(maps_a, outname + '_a')
+    kpasta_common.clear()   #data from first set of files shouldn't be used for second
+    print('\n Making second map...')
+    maps_b = Make_clim(files_b)
+    Save_outputs(maps_b, outname + '_b')
+    Compare_maps(maps_a, maps_b, outname)
+    return
+
+#Check how many cells change zone when using float32 rather than float64 precision
+# makes maps at both precisions, saving the float64 maps as outname and comparing them as in Compare_maps() with outname_precision,
+#  then prints and saves the number of cells and area that changed zone for each map to outname_precision.csv
+# returns dictionary with tuple of changed cells, total cells, and changed portion of surface area for each map
+#   files: list of input file names, or search string
+#   in_opts: dictionary of options or name of config file
+def Check_precision(files, in_opts=None):
+    if isinstance(files, str):
+        files = File_search(files)
+    Save_opts(in_opts)
+    outname = opt('outname')
+    precision = opt('precision')
+    try:
+        print('\n Making map at float64 precision...')
+        add_opt({'precision': 'float64'})
+        maps_a = Make_clim(files)
+        Save_outputs(maps_a, outname)
+        kpasta_common.clear()   #data at one precision shouldn't be reused for the other
+        print('\n Making map at float32 precision...')
+        add_opt({'precision': 'float32'})
+        maps_b = Make_clim(files)
+    finally:
+        add_opt({'precision': precision})
+    trans = Compare_maps(maps_a, maps_b, outname + '_precision')
+    report = {}
+    for k in trans:
+        change = maps_a[k] != maps_b[k]
+        changed = np.count_nonzero(change)
+        report[k] = (changed, change.size, np.sum(area_weight(change.shape)[0][change]))
+        print(f'  {changed} of {change.size} cells ({report[k][2]*100:.4f}% of surface area) changed zone in {k} map at float32 precision')
+    print(f'  Saving precision report to {outname}_precision.csv')
+    with open(outname + '_precision.csv', 'w') as f:
+        f.write('map,cells,changed_cells,changed_area\n')
+        for k, (changed, cells, area) in report.items():
+            f.write(f'{k},{cells},{changed},{area:.6g}\n')
+    return report
+
+#Save all outputs requested in options for maps
+#   maps: dictionary containing arrays of climate zones
+#   outname: name of output files
+def Save_outputs(maps, outname=None):
+    if opt('save_image'):
+        Make_image(maps, outname)
+    if opt('make_stats'):
+        Make_stats(maps, outname)
+
  
 
 ## Command functions
@@ -3932,6 +4962,9 @@ def Save_opts(in_opts=None):
             else:
                 print(f'WARNING: no file found at {f} for {o}')
 
+    if opt('region') is not None and not opt('interp_scale'):
+        print('WARNING: region is only applied when interpolating with interp_scale; making map of whole input grid')
+
     f = opt('outname')
     if "/" not in f and "\\" not in f:  #if outname doesn't look like a path, presume path should be added
         add_opt({'outname': path+f})
@@ -3964,9 +4997,44 @@ def Save_opts(in_opts=None):
 # returns dictionary of arrays with climates
 #  files: list of input files
 #  in_opts: dictionary of options or name of config file
-def Make_clim(files, in_opts=None):
+#   shared: dictionary of parameters already found for other land types in batch, to reuse if they share the same _Data and _Param functions
+def Make_clim(files, in_opts=None, shared=None):
     if in_opts:
         Save_opts(in_opts)
+    land_funcs, sea_funcs = Get_funcs()
+    params = Find_params(files, land_funcs, sea_funcs, shared)
+    maps = Get_clims(params, land_funcs, sea_funcs)
+
+            
+    return maps
+
+#Find climate parameters from files, reusing those already found in batch or saved in cache where possible
+# returns dictionary of climate parameters
+#  files: list of input files
+#  land_funcs, sea_funcs: lists of appropriate climate functions from Clim_func
+#   shared: dictionary of parameters already found for other land types in batch
+def Find_params(files, land_funcs, sea_funcs, shared=None):
+    params = None
+    cache_key = None
+    share_key = (land_funcs[0], land_funcs[1], sea_funcs[0], sea_funcs[1])
+    if land_funcs[1] is Biome_Param:
+        share_key += (opt('land_type'),)    #biome functions vary by land type
+    if shared is not None and share_key in shared:
+        print(f" Reusing climate parameters found for {shared[share_key][1]}...")
+        params = shared[share_key][0]
+    elif opt('cache_dir') and not opt('force_alt_data') and not opt('debug_file'):
+        cache_key = Cache_key(files, land_funcs, sea_funcs)
+        params = Load_cache(cache_key)
+    if params is None:
+        params = Get_params(files, land_funcs, sea_funcs)
+        if cache_key:
+            Save_cache(cache_key, params)
+    if shared is not None and share_key not in shared:
+        shared[share_key] = (params, opt('land_type'))
+    return params
+
+#Find land and sea climate functions from Clim_func for land_type and sea_type options
+def Get_funcs():
     if opt('efficient'):
         try:
             land_funcs = Clim_func[opt('land_type')+'_efficient']
@@ -3979,11 +5047,48 @@ def Make_clim(files, in_opts=None):
     else:
         land_funcs = Clim_func[opt('land_type')]
         sea_funcs = Clim_func[opt('sea_type')]
-    params = Get_params(files, land_funcs, sea_funcs)
-    maps = Get_clims(params, land_funcs, sea_funcs)
-
-            
-    return maps
+    return land_funcs, sea_funcs
+
+#Sum data across years, keeping time steps within the year separate
+#   data: data array with years linked along time dimension
+#   first, last: first year and year after last to sum
+#   steps: time steps per year
+def year_sum(data, first, last, steps):
+    return np.sum(data[first*steps:last*steps].reshape((last-first, steps) + data.shape[1:]), 0, dtype=np.float64)
+
+#Reduce map to another subtype using lookup table in Subtype_tables
+# returns dictionary of reduced maps, or None if subtype can't be derived from current subtype
+#   maps: dictionary of climate zone maps
+#   subtype: subtype to reduce to
+def Reduce_subtype(maps, subtype):
+    try:
+        bases, table = Subtype_tables[opt('land_type')][subtype]
+    except:
+        return None
+    if opt('land_subtype') not in bases:
+        return None
+    lut = np.arange(65536, dtype=np.uint16)     #zones not in table are unchanged
+    lut[list(table.keys())] = list(table.values())
+    return {k: lut[v] for k, v in maps.items()}
+
+#Produce images for each subtype in extra_subtypes that can be derived from maps
+# saved as outname_subtype
+#   maps: dictionary of climate zone maps
+def Make_extra_subtypes(maps):
+    subtypes = opt('extra_subtypes')
+    if not subtypes:
+        return
+    if isinstance(subtypes, str):
+        subtypes = [t.strip() for t in subtypes.split(',')]
+    for t in subtypes:
+        if t == opt('land_subtype'):
+            continue
+        sub_maps = Reduce_subtype(maps, t)
+        if sub_maps is None:
+            print(f" Can't derive {t} subtype from {opt('land_subtype')} {opt('land_type')} map; skipping")
+            continue
+        print(f" Making {t} subtype map...")
+        Save_outputs(sub_maps, outname=f"{opt('outname')}_{t}")
 
 #Main routine: finds configs, runs Make_clim, and then produces output map
 # files: name of file or list containing files
@@ -3992,10 +5097,367 @@ def Make_map(files, in_opts=None):
     if isinstance(files, str):      #makes sure files is a list
         files = File_search(files)
     Save_opts(in_opts)
+    if opt('land_type') == 'all' or isinstance(opt('land_type'), (list, tuple)) or ',' in opt('land_type'):
+        Make_map_batch(files)
+        return
+    if opt('window_years'):
+        Make_windows(files)
+        return
+    if opt('ensemble'):
+        Make_ensemble(files)
+        return
     maps = Make_clim(files)
-    Make_image(maps)
+    Save_outputs(maps)
+    Make_extra_subtypes(maps)
     return
 
+#Make maps for multiple land types, sharing extracted data and climate parameters between them where possible
+# outputs are saved as outname_landtype
+#   files: list containing files
+def Make_map_batch(files):
+    land_types = opt('land_type')
+    if land_types == 'all':
+        land_types = [k for k in Clim_func if not k.startswith(('sea_', 'Template')) and not k.endswith('_efficient')]
+    elif isinstance(land_types, str):
+        land_types = [t.strip() for t in land_types.split(',')]
+    outname = opt('outname')
+    shared = {}
+    for t in land_types:
+        print(f"\n Making {t} map...")
+        add_opt({'land_type': t, 'outname': f'{outname}_{t}'})
+        kpasta_common.pop('colmap', None)   #color map made for each land type
+        maps = Make_clim(files, shared=shared)
+        Save_outputs(maps)
+        Make_extra_subtypes(maps)
+    add_opt({'land_type': land_types, 'outname': outname})
+    return
+
+#Classify each file (e.g. ensemble member or year) separately, then find the most common zone in each cell and the portion of files agreeing with it
+# counts of each zone in each cell are updated file by file, so memory use depends on the number of zones found rather than the number of files
+# ties go to whichever zone was first found anywhere in the map
+# the modal map is saved as outname_mode, and the agreement as a grayscale image outname_agreement.png (white where all files agree),
+#  with both also saved as arrays to outname_agreement.npz
+# returns dictionary of modal maps and dictionary of agreement arrays
+#   files: list containing files
+def Make_ensemble(files):
+    land_funcs, sea_funcs = Get_funcs()
+    print(f" Classifying {len(files)} files separately...")
+    Warm_start(files)
+    counts = {}
+    zones = {}
+    lut = {}
+    for f in files:
+        print(f"\n Classifying {f}...")
+        par = Param_file(f, land_funcs, sea_funcs)[0]
+        maps = Get_clims(par, land_funcs, sea_funcs)
+        for k, v in maps.items():
+            if k not in counts:
+                counts[k] = np.zeros((0,) + v.shape, dtype=np.uint16)  #count of each zone found so far in each cell
+                zones[k] = []
+                lut[k] = np.zeros(65536, dtype=np.int64)    #position of each zone in counts
+            new = [z for z in np.flatnonzero(np.bincount(v.ravel())) if z not in zones[k]]
+            if new:
+                verb(f'   Found {len(new)} new zones in {k} map')
+                lut[k][new] = np.arange(len(zones[k]), len(zones[k]) + len(new))
+                zones[k] += new
+                counts[k] = np.concatenate((counts[k], np.zeros((len(new),) + v.shape, dtype=np.uint16)))
+            counts[k].reshape((len(zones[k]), -1))[lut[k][v].ravel(), np.arange(v.size)] += 1
+    Warm_save(files)
+
+    print("\n Finding most common zones...")
+    outname = opt('outname')
+    modes = {}
+    agree = {}
+    for k, c in counts.items():
+        top = np.argmax(c, 0)
+        modes[k] = np.array(zones[k], dtype=np.uint16)[top]
+        agree[k] = np.take_along_axis(c, top[None], 0)[0] / len(files)
+        weight = area_weight(top.shape)[0]
+        print(f'  Average agreement with most common zone in {k} map is {np.sum(weight*agree[k])*100:.1f}%')
+    Save_outputs(modes, outname + '_mode')
+    for k, a in agree.items():
+        if len(agree) > 1:
+            savename = outname + '_' + k + '_agreement'
+        else:
+            savename = outname + '_agreement'
+        print(f'  Saving agreement to {savename}.png')
+        outim = scale_image(Image.fromarray(np.round(a*255).astype(np.uint8)))
+        outim.save(savename + '.png')
+        np.savez_compressed(savename + '.npz', mode=modes[k], agreement=a)
+    return modes, agree
+
+#Find options that may be read by functions or anything they call, by searching their code for names of options
+# returns set of option names
+#   funcs: list of functions to search
+def find_opts(funcs):
+    found = set()
+    seen = set()
+    codes = [f.__code__ for f in funcs]
+    while codes:
+        c = codes.pop()
+        if c in seen:
+            continue
+        seen.add(c)
+        for k in c.co_consts:
+            if isinstance(k, str) and k in option_def:
+                found.add(k)
+            elif isinstance(k, types.CodeType):   #nested functions and comprehensions
+                codes.append(k)
+        for n in c.co_names:
+            g = globals().get(n)
+            if isinstance(g, types.FunctionType):
+                codes.append(g.__code__)
+            elif n == 'Derived_func':   #derived data functions are only called through Derived_func
+                codes += [f.__code__ for f, deps in g.values()]
+    return found
+
+#Make maps for many settings of options used in determining zones, while only finding climate parameters once
+# options that may affect climate parameters (i.e. used in _Data or _Param functions) are skipped, as they would need parameters found again
+# outputs for each setting are saved as outname_sweep<n>, numbered from 1,
+#  and the settings and portion of surface area covered by each zone for every setting are saved to outname_sweep.csv
+# returns list of settings and list of maps for each setting
+#   files: name of file or list containing files
+#   sweep: dictionary of option names and lists of values to try, with every combination of values used,
+#       or list of dictionaries of options for each setting
+#   in_opts: dictionary of options or name of config file, for options that aren't swept
+def Make_sweep(files, sweep, in_opts=None):
+    if isinstance(files, str):
+        files = File_search(files)
+    Save_opts(in_opts)
+    land_funcs, sea_funcs = Get_funcs()
+    if isinstance(sweep, dict):
+        settings = [dict(zip(sweep.keys(), v)) for v in itertools.product(*sweep.values())]
+    else:
+        settings = [dict(v) for v in sweep]
+    fixed = find_opts([Get_params, land_funcs[0], land_funcs[1], sea_funcs[0], sea_funcs[1]]) | set(warm_opts) | {'land_type', 'sea_type', 'efficient'}
+    names = []
+    for k in dict.fromkeys(k for v in settings for k in v):
+        if k in fixed:
+            print(f" {k} may affect climate parameters, so can't be swept without finding them again; skipping")
+            for v in settings:
+                v.pop(k, None)
+        else:
+            names.append(k)
+    settings = [v for i, v in enumerate(settings) if v not in settings[:i]]    #remove settings repeated after skipping options
+    
+    params = Find_params(files, land_funcs, sea_funcs)
+    outname = opt('outname')
+    base = {k: opt(k) for k in names}
+    all_maps = []
+    areas = []
+    for i, v in enumerate(settings):
+        print(f"\n Making map for setting {i+1} of {len(settings)}: {v}")
+        add_opt(base)
+        add_opt(v)
+        add_opt({'outname': f'{outname}_sweep{i+1}'})
+        maps = Get_clims(params, land_funcs, sea_funcs)
+        Save_outputs(maps)
+        all_maps.append(maps)
+        areas.append({k: np.bincount(m.ravel(), weights=area_weight(m.shape)[0].ravel()) for k, m in maps.items()})
+    add_opt(base)
+    add_opt({'outname': outname})
+
+    savename = outname + '_sweep.csv'
+    print(f"\n Saving zone areas for each setting to {savename}")
+    zones = {}
+    for a in areas:
+        for k, v in a.items():
+            zones.update({z: 0 for z in np.flatnonzero(v)})
+    zones = sorted(zones)
+    with open(savename, 'w') as f:
+        f.write(','.join(['setting'] + names + ['map'] + [f'"{zone_name(z)}"' for z in zones]) + '\n')
+        for i, (v, a) in enumerate(zip(settings, areas)):
+            for k, ar in a.items():
+                ar = np.concatenate((ar, np.zeros(max(0, zones[-1]+1-len(ar)))))
+                f.write(','.join([str(i+1)] + [str(v.get(n, base[n])) for n in names] + [k] + [f'{ar[z]:.6g}' for z in zones]) + '\n')
+    return settings, all_maps
+
+#Find how stable the zone of each cell is when climate parameters are perturbed with random noise, to find cells near zone boundaries
+# parameters are found once, then classified again for each draw of noise, with several draws stacked into each classification run
+# stability is the portion of draws in which a cell keeps its unperturbed zone
+# boundary distance estimates the distance to the nearest zone boundary in standard deviations of the noise, presuming a single flat boundary,
+#  and is capped where all draws keep the same zone
+# proximity is 1 - distance/cap, so it's 1 at zone boundaries and 0 far from them
+# stability and proximity are saved as grayscale images outname_stability.png and outname_proximity.png,
+#  and all three with unperturbed zones to outname_sensitivity.npz
+# returns dictionaries of unperturbed maps, stability, and boundary distance
+#   files: name of file or list containing files
+#   noise: dictionary of parameter names (e.g. Avg_Temp, Total_Precip, GDD, Ar) and standard deviation of normal noise to add to each,
+#       or strings of percentages (e.g. '10%') for noise relative to the parameter value
+#   draws: number of random draws
+#   in_opts: dictionary of options or name of config file
+#   seed: seed for random numbers
+#   batch: number of draws to classify at once; by default, enough to make about a million cells
+def Make_sensitivity(files, noise, draws=100, in_opts=None, seed=None, batch=None):
+    if isinstance(files, str):
+        files = File_search(files)
+    Save_opts(in_opts)
+    land_funcs, sea_funcs = Get_funcs()
+    params = Find_params(files, land_funcs, sea_funcs)
+    noise = dict(noise)
+    for k in list(noise):
+        if k not in params:
+            print(f" {k} not found in climate parameters; not perturbing it")
+            noise.pop(k)
+    base = Get_clims(params, land_funcs, sea_funcs)
+    mask = common('clim_mask')
+    if not batch:
+        batch = max(1, 1000000 // mask.size)
+    batch = min(batch, draws)
+
+    print(f" Classifying {draws} random draws of {list(noise)}, {batch} at a time...")
+    rng = np.random.default_rng(seed)
+    chart = opt('make_chart')
+    add_opt({'make_chart': False})
+    stable = {k: np.zeros(v.shape, dtype=np.int64) for k, v in base.items()}
+    pool_ctx = nullcontext()    #gives pool of None, so draws are classified here
+    if opt('param_processes') > 1 and draws > batch:
+        print(f"  Classifying draws in {opt('param_processes')} parallel processes")
+        shared = {k: v for k, v in kpasta_common.items() if not k.startswith('derived')}
+        pool_ctx = ProcessPoolExecutor(opt('param_processes'), initializer=Init_worker, initargs=(kpasta_options, shared))
+    with pool_ctx as pool:
+        jobs = deque()
+        done = 0
+        while done < draws:
+            n = min(batch, draws - done)
+            done += n
+            b_par = {k: np.tile(v, (n, 1)) for k, v in params.items() if v.ndim == 2}    #draws stacked along latitude axis
+            for k, sd in noise.items():
+                if isinstance(sd, str):
+                    b_par[k] *= 1 + rng.normal(0, float(sd.strip('%'))/100, b_par[k].shape)
+                else:
+                    b_par[k] += rng.normal(0, sd, b_par[k].shape)
+            b_par['mask'] = np.tile(mask, (n, 1))
+            if pool:
+                jobs.append((n, pool.submit(Get_clims, b_par, land_funcs, sea_funcs)))
+            else:
+                jobs.append((n, Get_clims(b_par, land_funcs, sea_funcs)))
+            del b_par
+            while jobs and (len(jobs) > opt('param_processes') or done >= draws):     #keep only a few batches waiting
+                n, maps = jobs.popleft()
+                if pool:
+                    maps = maps.result()
+                for k, v in maps.items():
+                    stable[k] += np.sum(v.reshape((n,) + base[k].shape) == base[k], 0)
+    add_opt({'make_chart': chart})
+    add_common('clim_mask', mask)
+
+    outname = opt('outname')
+    cap = ndtri(1 - 0.5/draws)
+    stability = {}
+    distance = {}
+    for k, v in stable.items():
+        stability[k] = v / draws
+        distance[k] = np.clip(ndtri(np.maximum(stability[k], 0.5)), 0, cap)
+        weight = area_weight(v.shape)[0]
+        print(f'  {np.sum(weight[v < draws])*100:.1f}% of surface area changed zone in at least one draw in {k} map')
+        if len(stable) > 1:
+            savename = outname + '_' + k
+        else:
+            savename = outname
+        print(f'  Saving stability and boundary proximity to {savename}_stability.png and {savename}_proximity.png')
+        for name, a in (('stability', stability[k]), ('proximity', 1 - distance[k]/cap)):
+            outim = scale_image(Image.fromarray(np.round(a*255).astype(np.uint8)))
+            outim.save(f'{savename}_{name}.png')
+        np.savez_compressed(savename + '_sensitivity.npz', zones=base[k], stability=stability[k], distance=distance[k])
+    return base, stability, distance
+
+#Make maps for rolling windows of window_years files over a long sequence of files, presumed to be one per year in order of file name
+# data is extracted once from all files linked in sequence, then for each window the mean of each time step of the year is found
+# the sum for the mean is kept from window to window, adding years entering the window and removing those leaving it
+# note fields derived while extracting data (e.g. PET, evaporation and sea ice for Biome types) are found for each year before averaging,
+#  so these can differ from combining the window's files with data combination, where they're derived from the averaged data
+# outputs are saved as outname_y<first>-<last> for each window, numbered by file from 1,
+#  the zone of each cell in every window is saved with the number of times it changed zone as outname_timeline.npz,
+#  and the lowest and highest annual mean of each data field in every window as outname_extremes.npz
+# returns list of maps for each window
+#   files: list containing files
+def Make_windows(files):
+    file_combine = opt('file_combine')
+    add_opt({'file_combine': 'seq'})
+    try:
+        return Window_maps(sorted(files))
+    finally:
+        add_opt({'file_combine': file_combine})
+
+#Classify rolling windows from files linked in sequence, as used by Make_windows
+# returns list of maps for each window
+#   files: sorted list containing files
+def Window_maps(files):
+    n_win = opt('window_years')
+    step = max(opt('window_step'), 1)
+    if n_win > len(files):
+        print(f" Only {len(files)} files found for windows of {n_win} years; using all files as a single window")
+        n_win = len(files)
+    land_funcs, sea_funcs = Get_funcs()
+    print(f" Extracting data from {files[0]} et al...")
+    print(f"  Classifying windows of {n_win} files every {step} files")
+    data = Get_data(files, land_funcs, sea_funcs)
+    n_t = max(v.shape[0] for v in data.values() if v.ndim > 2)  #length of time dimension with all files linked
+    steps = n_t // len(files)
+    if n_t % len(files):
+        print(f"  Linked data has {n_t} time steps, which can't be split evenly between {len(files)} files; presuming {steps} per file")
+    series = [k for k, v in data.items() if v.ndim > 2 and v.shape[0] == n_t]
+    verb(f'   Finding window means of {series}')
+    sums = {k: year_sum(data[k], 0, n_win, steps) for k in series}
+    annual = {k: np.stack([np.mean(year_sum(data[k], y, y+1, steps), 0) for y in range(len(files))]) for k in series}   #annual means for window extremes
+    
+    outname = opt('outname')
+    all_maps = []
+    labels = []
+    extremes = {k: ([], []) for k in series}
+    with ThreadPoolExecutor(1) as pool:    #no thread started unless animating
+        anim = None
+        if opt('animate'):
+            anim = Start_animation(pool, outname)
+        for first in range(0, len(files) - n_win + 1, step):
+            if first > 0:
+                for k in series:    #move window forward
+                    sums[k] += year_sum(data[k], first - step + n_win, first + n_win, steps)
+                    sums[k] -= year_sum(data[k], first - step, first, steps)
+            w_data = dict(data)
+            for k in series:
+                w_data[k] = (sums[k] / n_win).astype(data[k].dtype)
+                extremes[k][0].append(np.min(annual[k][first:first+n_win], 0))
+                extremes[k][1].append(np.max(annual[k][first:first+n_win], 0))
+            if opt('seasonless'):
+                for k, v in w_data.items():
+                    if v.ndim > 2:
+                        w_data[k] = np.mean(v, 0, keepdims=True)
+            label = f'y{first+1}-{first+n_win}'
+            labels.append(label)
+            print(f"\n Classifying window {label}...")
+            add_opt({'outname': f'{outname}_{label}'})
+            params = Calc_params(w_data, land_funcs, sea_funcs)
+            maps = Get_clims(params, land_funcs, sea_funcs)
+            Save_outputs(maps)
+            if anim:
+                Add_frame(anim, maps)
+            all_maps.append(maps)
+        add_opt({'outname': outname})
+        if anim:
+            End_animation(anim)
+
+    print("\n Saving change timeline...")
+    for k in all_maps[0]:
+        zones = np.stack([m[k] for m in all_maps])
+        changes = np.sum(zones[1:] != zones[:-1], 0)
+        weight = area_weight(changes.shape)[0]
+        print(f'  {np.sum(weight[changes > 0])*100:.1f}% of surface area changed zone at least once in {k} map')
+        if len(all_maps[0]) > 1:
+            savename = outname + '_' + k + '_timeline.npz'
+        else:
+            savename = outname + '_timeline.npz'
+        print(f'  Saving to {savename}')
+        np.savez_compressed(savename, zones=zones, changes=changes, windows=np.array(labels))
+    print(f'  Saving window extremes of annual means to {outname}_extremes.npz')
+    ext_out = {}
+    for k, (lows, highs) in extremes.items():
+        ext_out[k + '_min'] = np.stack(lows)
+        ext_out[k + '_max'] = np.stack(highs)
+    np.savez_compressed(outname + '_extremes.npz', windows=np.array(labels), **ext_out)
+    return all_maps
+
 
 
 
@@ -4118,14 +5580,10 @@ Clim_func['Template_efficient'] = (Template_Data, Template_Param, Template_Alg_e
 ## Koppen-Geiger
 
 def Koppen_Data(dat):
-    tas, adjust = Get_nc_adjust(dat, 'tas', 'grnz')
-
-    pr = Get_nc(dat, 'pr')
-    
     all_data = dict(
-        tas=tas + opt('temp_adjust'),    #convert from K to C
-        pr=pr * opt('precip_adjust'),  #convert from m/s to mm/month
-        adjust=adjust
+        tas=Get_derived(dat, 'tas'),    #2-meter air temp in C
+        pr=Get_derived(dat, 'pr'),  #precipitation in mm/month
+        adjust=Get_derived(dat, 'adjust')
         )
 
     if opt('kg_summer_zenith'):
@@ -4158,13 +5616,9 @@ def Koppen_Param(data):
             long = np.concatenate((tas,tas[:halfl,:,:]), axis=0)
         sum_ar = np.sum(np.stack([long[m:m+halfl] for m in range(halfl)], 0), axis=0)   #stack half-year slices together and then sum them together to produce array of total values over following half-year for each month
         pr_long = np.concatenate((pr,pr),axis=0)    #create double-length array of precipitation
-        pr_stack = np.stack([pr_long[m:m+timel] for m in range(timel)], axis=0)     #stack full-year slices together starting on each month of the year
         sum_max = np.argmax(sum_ar, axis=0)
         verb('    Finding summer and winter precipitation')
-        precips = np.empty_like(pr)
-        for y in range(pr.shape[1]):       #Bit of an inefficient approach, but haven't quite bothered to figured out how to do this as a numpy operation
-            for x in range(pr.shape[2]):
-                precips[:,y,x] = pr_stack[sum_max[y,x],:,y,x]    #choose appropriate slice corresponding to the maximum half-year total of indicator value
+        precips = np.take_along_axis(pr_long, sum_max + np.arange(timel)[:,None,None], 0)   #take full year of precipitation starting from the month with the maximum half-year total of indicator value
         Summer_Precip = np.mean(precips[:halfl,:,:], axis=0)*6    #convert to mm/half-year
         if timel%2 != 0:
             for y in range(pr.shape[1]):
@@ -4190,6 +5644,8 @@ def Koppen_Param(data):
     
     verb('    Determining length of "summer" above 10 C')
     Summer_Length = np.sum(np.where(tas>10,1,0), axis=0)/len(tas) #Portion of year above 10 C
+    if opt('precision'):
+        Summer_Length = Summer_Length.astype(opt('precision'))  #count-derived, so keep at working precision as well
 
     all_param = dict(
         Avg_Temp = Avg_Temp,
@@ -4437,6 +5893,32 @@ def Koppen_Alg(par):
 
 Clim_func['Koppen-Geiger'] = (Koppen_Data, Koppen_Param, Koppen_Alg)
 
+#Reductions from full Koppen set to other subtypes, matching choices made in Koppen_Alg
+Subtype_tables['Koppen-Geiger'] = {
+    'groups': (('full', 'two_letter', 'reduced'), {
+        **{z: A for z in (Af, Am, Aw, As, TropRainforest, TropMonsoon, TropSavanna)},
+        **{z: B for z in (BWh, BWk, BSh, BSk, BW, BS, HotDesert, ColdDesert, HotSteppe, ColdSteppe)},
+        **{z: C for z in (Csa, Csb, Csc, Cwa, Cwb, Cwc, Cfa, Cfb, Cfc, Cs, Cw, Cf, Med, Subtropical, Oceanic)},
+        **{z: D for z in (Dsa, Dsb, Dsc, Dsd, Dwa, Dwb, Dwc, Dwd, Dfa, Dfb, Dfc, Dfd, Ds, Dw, Df, Continental, Subarctic)},
+        **{z: E for z in (ET, EF, Tundra, IceCap)}
+        }),
+    'two_letter': (('full',), {
+        As: Aw,     #As only distinguished in full set
+        BWh: BW, BWk: BW, BSh: BS, BSk: BS,
+        Csa: Cs, Csb: Cs, Csc: Cs, Cwa: Cw, Cwb: Cw, Cwc: Cw, Cfa: Cf, Cfb: Cf, Cfc: Cf,
+        Dsa: Ds, Dsb: Ds, Dsc: Ds, Dsd: Ds, Dwa: Dw, Dwb: Dw, Dwc: Dw, Dwd: Dw, Dfa: Df, Dfb: Df, Dfc: Df, Dfd: Df
+        }),
+    'reduced': (('full',), {
+        Af: TropRainforest, Am: TropMonsoon, Aw: TropSavanna, As: TropSavanna,
+        BWh: HotDesert, BWk: ColdDesert, BSh: HotSteppe, BSk: ColdSteppe,
+        Csa: Med, Csb: Med, Csc: Med,
+        Cwa: Subtropical, Cfa: Subtropical, Cwb: Oceanic, Cwc: Oceanic, Cfb: Oceanic, Cfc: Oceanic,
+        Dsa: Continental, Dsb: Continental, Dwa: Continental, Dwb: Continental, Dfa: Continental, Dfb: Continental,
+        Dsc: Subarctic, Dsd: Subarctic, Dwc: Subarctic, Dwd: Subarctic, Dfc: Subarctic, Dfd: Subarctic,
+        ET: Tundra, EF: IceCap
+        })
+    }
+
 ## Trewartha
 
 def Trewartha_Alg(par):
@@ -4531,22 +6013,24 @@ def Trewartha_Alg(par):
 
 Clim_func['Trewartha'] = (Koppen_Data, Koppen_Param, Trewartha_Alg) #Shares data and parameters with koppen
 
+Subtype_tables['Trewartha'] = {
+    'groups': (('full',), {
+        TrAr: TrA, TrAw: TrA, TrAs: TrA, TrBW: TrB, TrBS: TrB, TrCs: TrC, TrCw: TrC, TrCf: TrC,
+        TrDo: TrD, TrDc: TrD, TrEo: TrE, TrEc: TrE, TrFt: TrF, TrFi: TrF
+        })
+    }
+
 ## Holdridge Life Zones
 
 def Holdridge_Data(dat):
-    tas, adjust = Get_nc_adjust(dat, 'tas', 'grnz')
-
-    pr = Get_nc(dat, 'pr')
-    
     all_data = dict(
-        tas=tas + opt('temp_adjust'),    #convert from K to C
-        pr=pr * opt('precip_adjust'),  #convert from m/s to mm/month
-        adjust=adjust
+        tas=Get_derived(dat, 'tas'),    #2-meter air temp in C
+        pr=Get_derived(dat, 'pr'),  #precipitation in mm/month
+        adjust=Get_derived(dat, 'adjust')
         )
     
     if not opt('h_no_pet'):
-        pet = Get_pet(dat, all_data)
-        all_data['pet'] = pet
+        all_data['pet'] = Get_derived(dat, 'pet')
         
     return all_data
 
@@ -4742,24 +6226,12 @@ Clim_func['Holdridge'] = (Holdridge_Data, Holdridge_Param, Holdridge_Alg)
 ##Thornthwaite-Feddema
 
 def Thornthwaite_Data(dat):
-    tas, adjust = Get_nc_adjust(dat, 'tas', 'grnz')
-    tas += opt('temp_adjust') #convert from K to C
-
-    pr = Get_nc(dat, 'pr')
-
-    pet = Get_pet(dat,{'tas': tas})
-    
     all_data = dict(
-        pr=pr * opt('precip_adjust'),  #convert from m/s to mm/month
-        tas = tas,  #include for sea zones for chart
-        pet = pet,
-        adjust=adjust
+        pr=Get_derived(dat, 'pr'),  #precipitation in mm/month
+        tas=Get_derived(dat, 'tas'),  #include for sea zones for chart
+        pet=Get_derived(dat, 'pet'),
+        adjust=Get_derived(dat, 'adjust')
         )
-    
-    if opt('interp_scale') and opt('topo_map'):
-        all_data['adjust'] = adjust
-    
-
         
     return all_data
 
@@ -4922,14 +6394,10 @@ Clim_func['Thornthwaite'] = (Thornthwaite_Data, Thornthwaite_Param, Thornthwaite
 ##Whittaker Biomes
 
 def Whittaker_Data(dat):
-    tas, adjust = Get_nc_adjust(dat, 'tas', 'grnz')
-
-    pr = Get_nc(dat, 'pr')
-
     all_data = dict(
-        tas=tas + opt('temp_adjust'),    #convert from K to C
-        pr=pr*opt('precip_adjust'),     #convert from m/s to mm/month
-        adjust=adjust
+        tas=Get_derived(dat, 'tas'),    #2-meter air temp in C
+        pr=Get_derived(dat, 'pr'),     #precipitation in mm/month
+        adjust=Get_derived(dat, 'adjust')
         )
 
     return all_data
@@ -5081,29 +6549,13 @@ Clim_func['TwoParamKG'] = (Whittaker_Data, Whittaker_Param, TwoParamKG_Alg)
 ##Woodward Vegetation Types
 
 def Woodward_Data(dat):
-
-    tas, adjust = Get_nc_adjust(dat, 'tas', 'grnz')
-
-    if opt('temp_adjust_ts'):
-        ts = Get_nc(dat, 'ts', adjust=adjust)
-        tdif = tas-ts
-    else:
-        tdif = 0
-    mint = Get_nc(dat, 'mint', adjust=adjust+tdif, bin_ext = -1)
-
-
-    pr = Get_nc(dat, 'pr')
-    
     all_data = dict(
-        tas=tas+opt('temp_adjust'),
-        mint=mint+opt('temp_adjust'),
-        pr=pr*opt('precip_adjust'),    #convert from m/s to mm/month
-        adjust=adjust
+        tas=Get_derived(dat, 'tas'),    #2-meter air temp in C
+        mint=Get_derived(dat, 'mint'),  #daily minimum in C
+        pr=Get_derived(dat, 'pr'),    #precipitation in mm/month
+        adjust=Get_derived(dat, 'adjust'),
+        pet=Get_derived(dat, 'pet')
         )
-    
-    pet = Get_pet(dat,all_data)
-
-    all_data['pet'] = pet
 
     return all_data
 
@@ -5274,87 +6726,43 @@ Clim_func['WCR'] = (Woodward_Data, Woodward_Param, WCR_Alg)
 
 def Biome_Data(dat):
 
-    tas, adjust = Get_nc_adjust(dat, 'tas', 'grnz', t_unadjust=True)    #get unadjusted tas at first
-
-    rss = Get_nc(dat, 'rss')
-    ps = Get_nc(dat, 'ps')
-
     if opt('temp_tunings') == 'tavg':
         verb('    Skipping maxt and mint extracting, just using average temp')
-        maxt = - opt('temp_adjust')
-        mint = - opt('temp_adjust')
+        maxt = mint = Get_derived(dat, 'tas')
         tdif = 0
     else:
-        if opt('temp_adjust_ts'):
-            verb('    Finding adjustment from surface temp to 2-meter air temp')
-            ts = Get_nc(dat, 'ts')
-            tdif = tas - ts #adjustment from surface to 2-meter to apply to maxt and mint
-        else:
-            tdif = 0
-        maxt = Get_nc(dat, 'maxt', adjust=tdif, bin_ext = 1)
-        mint = Get_nc(dat, 'mint', adjust=tdif, bin_ext = -1)
-    pr = Get_nc(dat, 'pr', no_interp = True)
+        maxt = Get_derived(dat, 'maxt')
+        mint = Get_derived(dat, 'mint')
+        tdif = Get_derived(dat, 'tdif')
 
-    if opt('estimate_evap') == 'all' or (opt('interp_scale') and opt('estimate_evap') == 'sea'):
-        verb('    Gathering data to estimate evapotranspiration')
-        pet_small = Get_pet(dat, {}, no_interp = True)  #use original resolution
-        evap = Estimate_evap(pet_small, pr*opt('precip_adjust'))  #estimate evaporation from pet and pr
-        if opt('estimate_evap') == 'sea':
-            verb('    Combining evap data for land with estimated evap for sea')
-            evap_land = Get_nc(dat, 'evap', no_interp = True)
-            evap_land *= -opt('precip_adjust')   #convert from m/s to mm/month (and flip sign)
-            evap = np.where(get_mask(dat, 'lsm', convert=True), evap_land, evap)    #apply evap estimation only to sea areas
-        if opt('interp_scale'):
-            evap = Interp(evap)
-    else:
-        evap = Get_nc(dat, 'evap')
-        evap *= -opt('precip_adjust')   #convert from m/s to mm/month (and flip sign)
-    
-    pet= Get_pet(dat,
-                    {
-                        'tas':tas + opt('temp_adjust'),
-                        'rss':rss,
-                        'ps':ps,
-                        'maxt':maxt + opt('temp_adjust'),
-                        'mint':mint + opt('temp_adjust')
-                    })
-    
-    pet = np.maximum(pet,evap)  #ensure pet is always >= evaporation
-
-    tas += adjust   #apply temperature adjustments at end, so they don't affect PET
-    maxt += adjust  #because we can't apply any adjustments to evap, so adjusting only PET would have weird effects on Ar
-    mint += adjust
+    evap = Get_derived(dat, 'evap')
+    pet = np.maximum(Get_derived(dat, 'pet_unadj'), evap)  #ensure pet is always >= evaporation
+        #temperature adjustments aren't applied to PET because we can't apply any adjustments to evap, so adjusting only PET would have weird effects on Ar
 
+    pr = Get_derived(dat, 'pr', no_interp = True)
     if opt('interp_scale'):
         pr = Interp(pr)
     
-    ssru = Get_nc(dat, 'ssru')
-    rin = rss - ssru
-    
     all_data = dict(
-        tas=tas + opt('temp_adjust'),    #convert from K to C
-        mint=mint + opt('temp_adjust'),  #convert from K to C
-        maxt=maxt + opt('temp_adjust'),  #convert from K to C
+        tas=Get_derived(dat, 'tas'),    #2-meter air temp in C
+        mint=mint,
+        maxt=maxt,
         evap=evap,
         pet=pet,
-        pr=pr * opt('precip_adjust'),
-        ps=ps,
-        rin=rin,
-        adjust=adjust,
+        pr=pr,
+        ps=Get_derived(dat, 'ps'),
+        rin=Get_derived(dat, 'rin'),
+        adjust=Get_derived(dat, 'adjust'),
         tdif=tdif,
         )
     
     if opt('land_type') != 'Prentice':
         if opt('pas_ice_def') in ('ice', 'ice_noadj'):
-            snd = Get_nc(dat, 'snd', no_interp = True, bin_ext = -1)
-            ice = np.minimum(snd,0.4)   #helps get smoother interpolation
-            if opt('interp_scale'):
-                ice = Interp(ice)
-                if opt('pas_ice_def') == 'ice':
-                    all_data['tice'] = maxt - tdif + opt('temp_adjust') #unadjusted max surface temperature for ice adjustments with interpolation
-            all_data['ice'] = ice
+            if opt('interp_scale') and opt('pas_ice_def') == 'ice':
+                all_data['tice'] = maxt - tdif #unadjusted max surface temperature for ice adjustments with interpolation
+            all_data['ice'] = Get_derived(dat, 'ice')
         elif opt('pas_ice_def') == 'maxt':
-            all_data['tice'] = maxt - tdif + opt('temp_adjust')
+            all_data['tice'] = maxt - tdif
 
 
     return all_data
@@ -5475,6 +6883,8 @@ def Biome_Param(data):
             boilp = np.where(maxt > 108.3, 10**(10.26509-1810.94/(244.485+maxt)), 10**(10.19621-1730.63/(233.426+maxt)))     #antoine equation
             boil = np.where(maxt > 0, np.where(ps*100 < boilp, 1, 0), 0)
             boil = np.amax(boil,0)
+            if opt('precision'):
+                boil = boil.astype(opt('precision'))    #1 where boiling, 0 otherwise
             all_param['boil'] = boil
 
     
@@ -6071,6 +7481,32 @@ def Pasta_Alg(par):
 
 Clim_func['Pasta'] = (Biome_Data, Biome_Param, Pasta_Alg)
 
+#Reductions for Pasta subtypes; disabling pluvial zones just replaces each with the non-pluvial equivalent
+pasta_no_pluv = {
+    TUrp: TUr, TUfp: TUf, TUsp: TUs, TUAp: TUA, TQfp: TQf, TQsp: TQs, TQAp: TQA,
+    CTfp: CTf, CTsp: CTs, CDap: CDa, CDbp: CDb, CEap: CEa, CEbp: CEb, CEcp: CEc, CAap: CAa, CAbp: CAb,
+    HTfp: HTf, HTsp: HTs, HDap: HDa, HDbp: HDb, HDcp: HDc, HAap: HAa, HAbp: HAb, HAcp: HAc,
+    ETfp: ETf, ETsp: ETs, EDap: EDa, EDbp: EDb, EAap: EAa, EAbp: EAb
+    }
+pasta_simple = {    #matches simplified zones at end of Pasta_Alg
+    TUr: TUf, TG: TF,
+    **{z: CT for z in (CTf, CTs)}, **{z: CD for z in (CDa, CDb)}, **{z: CE for z in (CEa, CEb, CEc)},
+    **{z: CM for z in (CMa, CMb, CAMa, CAMb)}, **{z: CA for z in (CAa, CAb)}, **{z: CF for z in (CFa, CFb, CG)},
+    **{z: HT for z in (HTf, HTs)}, **{z: HD for z in (HDa, HDb, HDc)}, **{z: HM for z in (HMa, HMb, HMc, HAMa, HAMb, HAMc)},
+    **{z: HA for z in (HAa, HAb, HAc)}, **{z: HF for z in (HFa, HFb, HFc, HG)},
+    **{z: ET for z in (ETf, ETs)}, **{z: ED for z in (EDa, EDb)}, **{z: EM for z in (EMa, EMb, EAMa, EAMb)},
+    **{z: EA for z in (EAa, EAb)}, **{z: EF for z in (EFa, EFb, EG)},
+    **{z: Ad for z in (Ada, Adc, Adh, Ade)}, **{z: Ah for z in (Aha, Ahc, Ahh, Ahe)}
+    }
+pasta_simple.update({p: pasta_simple.get(z, z) for p, z in pasta_no_pluv.items()})
+
+Subtype_tables['Pasta'] = {
+    'no_pluv': (('full',), pasta_no_pluv),
+    'earthlike_no_pluv': (('earthlike',), pasta_no_pluv),
+    'simple': (('full', 'no_pluv'), pasta_simple),
+    'simple_earthlike': (('earthlike', 'earthlike_no_pluv'), pasta_simple)
+    }
+
 ##Koppen-Geiger Unproxied
 
 def Unproxied_Alg(par):
@@ -6303,6 +7739,9 @@ def Unproxied_Alg(par):
 
 Clim_func['KG_unproxied'] = (Biome_Data, Biome_Param, Unproxied_Alg)
 
+Subtype_tables['KG_unproxied'] = dict(Subtype_tables['Koppen-Geiger'])
+Subtype_tables['KG_unproxied']['two_letter'] = (('full',), {k: v for k, v in Subtype_tables['Koppen-Geiger']['two_letter'][1].items() if k != As})    #As kept in two-letter set
+
 
 ## Sea zones
 
@@ -6319,24 +7758,12 @@ def Sea_Data(dat, data):
         else:
             tkey = 'tas'
         if tkey not in data:
-            if opt('interp_scale') and opt('topo_map'):
-                if 'adjust' not in data:
-                    tkey_dat, adjust = Get_nc_adjust(dat, tkey, 'grnz')
-                    data[tkey] = tkey_dat = adjust + opt('temp_adjust')    #convert to C and add ajustment
-                else:
-                    tkey_dat, was_in = Get_nc_if(dat, tkey, data, tkey)
-                    if not was_in:
-                        tkey_dat += data['adjust'] + opt('temp_adjust')    #convert to C and add ajustment
-                        data[tkey] = tkey_dat
-            else:
-                tkey_dat, was_in = Get_nc_if(dat, tkey, data, tkey)
-                if not was_in:
-                    tkey_dat += opt('temp_adjust')    #convert to C and add ajustment
-                    data[tkey] = tkey_dat
+            data[tkey] = Get_derived(dat, tkey)     #temp in C with adjustment
             
     if not opt('sea_ice_use_temp'):
         get_mask(dat, 'lsm', convert=True)
-        data['sic'], was_in = Get_nc_if(dat, 'sic', data, 'sic', dummy_ice = opt('dummy_ice'))
+        if 'sic' not in data:
+            data['sic'] = Get_derived(dat, 'sic')
         
     return data
 
@@ -6449,43 +7876,27 @@ def Pasta_Sea_Data(dat, data):
             tkey = 'ts'
         else:
             tkey = 'tas'
-        if opt('interp_scale') and opt('topo_map'):
-            if 'adjust' not in data:
-                tkey_dat, adjust = Get_nc_adjust(dat, tkey, 'grnz')
-                data[tkey] = tkey_dat = adjust + opt('temp_adjust')    #convert to C and add ajustment
-            else:
-                tkey_dat, was_in = Get_nc_if(dat, tkey, data, tkey)
-                if not was_in:
-                    tkey_dat += data['adjust'] + opt('temp_adjust')    #convert to C and add ajustment
-                data[tkey] = tkey_dat
-        else:
-            tkey_dat, was_in = Get_nc_if(dat, tkey, data, tkey)
-            if not was_in:
-                tkey_dat += opt('temp_adjust')    #convert to C and add ajustment
-            data[tkey] = tkey_dat
+        if tkey not in data:
+            data[tkey] = Get_derived(dat, tkey)     #temp in C with adjustment
 
         if opt('sea_subtype') == 'full' and opt('gdd_limit_light'):
-            rss, was_in = Get_nc_if(dat, 'rss', data, 'rin')
-            if not was_in:
-                ssru = Get_nc(dat, 'ssru')
-                data['rin'] = rss - ssru
+            if 'rin' not in data:
+                data['rin'] = Get_derived(dat, 'rin')
 
     if not opt('sea_ice_use_temp'):
         if opt('pas_ice_def') in ('ice', 'ice_noadj'):
-            sic = Get_nc(dat, 'sic', dummy_ice = opt('dummy_ice'))
+            sic = Get_derived(dat, 'sic')
             if opt('interp_scale'):
                 if 'ice' in data:
                     ice = data['ice']
                 else:
-                    snd = Get_nc(dat, 'snd', no_interp = True)
-                    ice = np.minimum(snd, 0.4)
-                    ice = Interp(ice)
+                    ice = Get_derived(dat, 'ice')
                 get_mask(dat, 'lsm', True)
                 mask = common('mask_big')
                 sic = np.where(mask, np.maximum(sic, ice*10), sic)  #on land areas treat 1 cm of ice as equivalent to 10% sea ice cover
             data['sic'] = sic
-        else:
-            data['sic'], was_in = Get_nc_if(dat, 'sic', data, 'sic', dummy_ice = opt('dummy_ice'))
+        elif 'sic' not in data:
+            data['sic'] = Get_derived(dat, 'sic')
             
     return data
 
@@ -6593,27 +8004,12 @@ def Extra_Data(dat, data):
     if opt('make_chart'):
         try:
             if 'tas' not in data:
-                if opt('interp_scale') and opt('topo_map'):
-                    if 'adjust' not in data:
-                        lat, lon = coords_from_file(dat,'lat','lon')
-                        coords = (lat,lon)
-                        tkey_dat, adjust = Get_nc_adjust(dat, 'tas', 'grnz', coords)
-                        data['tas'] = tkey_dat = adjust + opt('temp_adjust')    #convert to C and add ajustment
-                    else:
-                        tkey_dat, was_in = Get_nc_if(dat, 'tas', data, 'tas')
-                        if not was_in:
-                            tkey_dat += data['adjust'] + opt('temp_adjust')    #convert to C and add ajustment
-                            data['tas'] = tkey_dat
+                data['tas'] = Get_derived(dat, 'tas')   #temp in C with adjustment
+            if 'pr' not in data:
+                if np.amax(Get_derived(dat, 'pr_raw')) < 1: #try to avoid converting if not m/s as presumed
+                    data['pr'] = Get_derived(dat, 'pr')  #convert from m/s to mm/month
                 else:
-                    tkey_dat, was_in = Get_nc_if(dat, 'tas', data, 'tas')
-                    if not was_in:
-                        tkey_dat += opt('temp_adjust')    #convert to C
-                        data['tas'] = tkey_dat
-            pr, was_in = Get_nc_if(dat, 'pr', data, 'pr')
-            if not was_in:
-                if np.amax(pr) < 1: #try to avoid converting if not m/s as presumed
-                    pr*=opt('precip_adjust')  #convert from m/s to mm/month
-                data['pr'] = pr
+                    data['pr'] = Get_derived(dat, 'pr_raw')
         except:
             pass
     return data
@@ -0,0 +1,58 @@
+import os
+import sys
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import koppenpasta as kp
+
+
+#Write a small ExoPlaSim-like output file with the variables used by the Koppen-Geiger functions, including PET for KG_unproxied
+def make_file(fname, seed, nt=12, nlat=32, nlon=64):
+    rng = np.random.default_rng(seed)
+    lat = np.linspace(90-90/nlat, -90+90/nlat, nlat)
+    lon = np.linspace(0, 360-360/nlon, nlon)
+    lat_r = np.radians(lat)[None,:,None]
+    lon_r = np.radians(lon)[None,None,:]
+    season = np.cos(2*np.pi*(np.arange(nt)-6)/nt)[:,None,None]
+    lsm = (np.sin(3*lon_r)*np.cos(2*lat_r) + 0.3*np.sin(5*lat_r) > 0.1) + 0*season
+    tas = 258 + 30*np.cos(lat_r)**2 + 15*season*np.sin(lat_r) + rng.normal(0, 1, (nt, nlat, nlon))
+    pr = np.abs(3e-8*(1 + np.cos(6*lat_r) + 0.5*season*np.sin(lon_r)) + rng.normal(0, 5e-9, tas.shape))
+    rss = np.maximum(250*np.cos(lat_r)*(1 + 0.3*season*np.sin(lat_r)), 0) + 0*lon_r
+    low = np.zeros((nt, 2, nlat, nlon))     #near-surface layer last
+    with nc.Dataset(fname, 'w') as d:
+        d.createDimension('time', nt)
+        d.createDimension('lat', nlat)
+        d.createDimension('lon', nlon)
+        d.createDimension('lev', 2)
+        d.createVariable('lat', 'f4', ('lat',))[:] = lat
+        d.createVariable('lon', 'f4', ('lon',))[:] = lon
+        for k, v in (('tas', tas), ('ts', tas + 1), ('maxt', tas + 6), ('mint', tas - 6), ('pr', pr), ('evap', -0.6*pr), ('lsm', lsm), ('sic', np.where((tas < 271) & (lsm < 0.5), 0.9, 0.0)),
+                     ('rss', rss), ('rls', -60 + 0*tas), ('ssru', -0.2*rss), ('ps', 1013 + 0*tas), ('tso', tas - 2), ('grnz', 0*tas), ('snd', np.where(tas < 268, 0.5, 0.0)*lsm)):
+            d.createVariable(k, 'f4', ('time', 'lat', 'lon'))[:] = v
+        for k, v in (('hur', 70 + 10*np.sin(lon_r)[:,None] + low), ('spd', 3 + low)):
+            d.createVariable(k, 'f4', ('time', 'lev', 'lat', 'lon'))[:] = v
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    path = tmp_path_factory.mktemp('data')
+    names = [str(path / f'run_{i}.nc') for i in range(2)]
+    for i, n in enumerate(names):
+        make_file(n, i)
+    return names
+
+
+#Reducing a map of one subtype to another should match classifying the other subtype directly
+@pytest.mark.parametrize('land_type', ['Koppen-Geiger', 'KG_unproxied'])
+@pytest.mark.parametrize('base, subtype', [('full', 'groups'), ('two_letter', 'groups'), ('reduced', 'groups'), ('full', 'two_letter'), ('full', 'reduced')])
+def test_reduce_subtype(files, tmp_path, land_type, base, subtype):
+    kp.Save_opts({'land_type': land_type, 'land_subtype': base, 'outname': str(tmp_path / 'out')})
+    reduced = kp.Reduce_subtype(kp.Make_clim(files), subtype)
+    assert reduced is not None
+    kp.Save_opts({'land_type': land_type, 'land_subtype': subtype, 'outname': str(tmp_path / 'out')})
+    direct = kp.Make_clim(files)
+    for k in direct:
+        assert np.array_equal(reduced[k], direct[k])